@@ -2,98 +2,1557 @@
 # Purpose: proof of concept 'curator' app leveraging Met Museum Open Access API
 
 import logging # used for logging
-import requests # used for rest
-from urllib.parse import urlencode  #used to convert dictionary to rest parameters
-from urllib.request import urlopen # used in retrieving image
+from urllib.parse import urlencode, urlsplit  #used to convert dictionary to rest parameters
+from collections import Counter, OrderedDict # used for LRU caches and repeated IDs
 import sqlite3 # used for local cache of data
 import io # used to handle byte stream for image
-from PIL import Image, ImageTk  # used to handle images
-import pandas # for parsing sql
-#GUI
-from tkinter import END, Frame, messagebox, Tk, TOP, BOTTOM, LEFT, RIGHT, BOTH, HORIZONTAL, SUNKEN, X, Y, BooleanVar, DoubleVar, IntVar, StringVar
-from tkinter.ttk import Button, Checkbutton, Entry, Frame, Label, Panedwindow, Scale, Spinbox, Style, Treeview # this overrides older controls in tkinter with newer tkk versions
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait as waitForFutures
+import threading # used to guard shared counters
+import queue # used to hand streamed results between threads
+import json # used to store cached REST responses
+import re # used to scan .curator files
+import time # used to timestamp cache entries
+import random # used to jitter retry backoff
+import os # used for the on-disk image cache
+import hashlib # used to name cached images
+from contextlib import contextmanager # used for database transactions
+import atexit # used to close database connections on exit
+import sys # used to intern repeated result strings
+import weakref # used to close read connections of finished threads
+from array import array # used to pack result object IDs
+import asyncio # used by the asyncio fetch engine
+# requests, PIL and httpx are imported where they are first used so
+# the core loads quickly and without a GUI; the GUI lives in curatorApp.py
 
 DB_PATH = "curator.db"
+# Default number of concurrent object lookups, also used to size the HTTP pool
+DEFAULT_MAX_WORKERS = 16
+# (connect, read) timeouts in seconds for every REST call
+DEFAULT_TIMEOUT = (3.05, 30)
+# Default number of in-flight requests for the asyncio fetch engine
+DEFAULT_MAX_CONCURRENCY = 64
+# Client-side rate limit per host in requests per second (the Met allows
+# about 80) and how many requests the token bucket lets through at once
+DEFAULT_RATE_LIMIT = 80
+DEFAULT_RATE_BURST = DEFAULT_MAX_WORKERS
+# Retries for throttled, 5xx and dropped requests, with jittered exponential
+# backoff starting at BACKOFF_BASE seconds and capped at BACKOFF_CAP
+DEFAULT_MAX_RETRIES = 4
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 8.0
+# Engines available to Query.fetchArtObjects
+ENGINE_THREADED = 'threaded'
+ENGINE_ASYNC = 'async'
+# Where Query looks up searches and object details: the REST API or the
+# local mirror of MetObjects.csv built by parse_to_sql.py
+BACKEND_REMOTE = 'remote'
+BACKEND_LOCAL = 'local'
+# Open Access API department IDs
+DEPARTMENTS = {
+    "American Decorative Arts" : 1,
+    "Ancient Near Eastern Art" : 3,
+    "Arms and Armor" : 4,
+    "Arts of Africa, Oceania, and the Americas" : 5,
+    "Asian Art" : 6,
+    "The Cloisters" : 7,
+    "The Costume Institute" : 8,
+    "Drawings and Prints" : 9,
+    "Egyptian Art" : 10,
+    "European Paintings" : 11,
+    "European Sculpture and Decorative Arts" : 12,
+    "Greek and Roman Art" : 13,
+    "Islamic Art" : 14,
+    "The Robert Lehman Collection" : 15,
+    "The Libraries" : 16,
+    "Medieval Art" : 17,
+    "Musical Instruments" : 18,
+    "Photographs" : 19,
+    "Modern Art" : 21,
+}
+# Marks the end of a stream of ArtObjects passed through a queue
+END_OF_RESULTS = object()
+# Number of results fetched per page by Query.pagedResults
+DEFAULT_PAGE_SIZE = 100
+# Seconds a cached object record is served before it is revalidated
+DEFAULT_OBJECT_TTL = 24 * 60 * 60
+# Seconds a cached search result is served, and how many are kept in memory
+DEFAULT_SEARCH_TTL = 60 * 60
+DEFAULT_SEARCH_CACHE_SIZE = 128
+# On-disk image store location and size budget, and decoded images kept in memory
+IMAGE_CACHE_DIR = "imageCache"
+DEFAULT_IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_DECODED_IMAGES = 64
+# Background image prefetch: rows on each side of the selection, worker count
+# and download budget in bytes per second (None for unlimited)
+DEFAULT_PREFETCH_ROWS = 3
+DEFAULT_PREFETCH_WORKERS = 2
+DEFAULT_PREFETCH_BYTES_PER_SECOND = 2 * 1024 * 1024
+# Seconds a favorites change waits before it is written to the Database
+DEFAULT_FAVORITES_FLUSH_DELAY = 1.0
+# Characters read at a time when importing a .curator file
+FAVORITES_CHUNK_SIZE = 64 * 1024
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 
+def favoriteKey(objectId):
+    '''
+    Normalised favorites key: IDs from queries are int, those from the db are str
+    '''
+    return str(objectId).strip()
+
+
+# Histogram bucket upper bounds for durations in seconds and sizes in bytes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+# Port for the localhost Prometheus endpoint
+DEFAULT_METRICS_PORT = 9464
+
+
+class _Timer:
+    # observes the seconds spent inside a with block
+    __slots__ = ('_metrics', '_name', '_started')
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.observe(self._name, time.perf_counter() - self._started)
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NO_TIMER = _NoTimer()
+
+
+class Metrics:
+    '''
+    Process wide counters, gauges, histograms and timers, named like
+    'query.search.seconds'. Off until enable() is given one or more sinks;
+    while off every call returns straight away.
+    '''
+    def __init__(self):
+        self._enabled = False
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        # name -> [buckets, bucket counts, sum, count]
+        self._histograms = {}
+        self._sinks = []
+        self._flusher = None
+        self._stopFlushing = threading.Event()
+
+    def isEnabled(self):
+        return self._enabled
+
+    def enable(self, *sinks, interval=None):
+        '''
+        Start collecting and report to sinks, flushing every interval
+        seconds when given
+        '''
+        self._sinks.extend(sinks)
+        self._enabled = True
+        if interval and self._flusher is None:
+            self._stopFlushing.clear()
+            self._flusher = threading.Thread(target=self._flushEvery, args=(interval,), name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def disable(self):
+        '''
+        Stop collecting, write a last snapshot and close the sinks
+        '''
+        if self._flusher is not None:
+            self._stopFlushing.set()
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        self._enabled = False
+        for sink in self._sinks:
+            sink.close()
+        self._sinks = []
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def increment(self, name, value=1):
+        if not self._enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def setGauge(self, name, value):
+        if not self._enabled:
+            return
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        if not self._enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = [buckets, [0] * len(buckets), 0.0, 0]
+                self._histograms[name] = histogram
+            for i, bound in enumerate(histogram[0]):
+                if value <= bound:
+                    histogram[1][i] += 1
+                    break
+            histogram[2] += value
+            histogram[3] += 1
+
+    def timer(self, name):
+        '''
+        with metrics.timer(name): observes the block's duration in seconds
+        '''
+        if not self._enabled:
+            return _NO_TIMER
+        return _Timer(self, name)
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {}
+            for name, (buckets, counts, total, count) in self._histograms.items():
+                histograms[name] = {'buckets': list(zip(buckets, counts)), 'sum': total, 'count': count}
+            return {'counters': dict(self._counters), 'gauges': dict(self._gauges), 'histograms': histograms}
+
+    def flush(self):
+        if not self._enabled or not self._sinks:
+            return
+        snapshot = self.snapshot()
+        for sink in self._sinks:
+            try:
+                sink.write(snapshot)
+            except Exception as e:
+                logging.debug(f'Metrics sink failed: {str(e)}')
+
+    def _flushEvery(self, interval):
+        while not self._stopFlushing.wait(interval):
+            self.flush()
+
+    def configure(self, spec):
+        '''
+        Enable from a spec such as 'jsonl:metrics.jsonl',
+        'jsonl:metrics.jsonl:10' (flush every 10s) or 'prometheus:9464'.
+        An empty spec leaves metrics off.
+        '''
+        if not spec:
+            return
+        kind, _, rest = spec.partition(':')
+        if kind == 'jsonl':
+            path, _, interval = rest.partition(':')
+            self.enable(JsonLinesSink(path or 'curator-metrics.jsonl'), interval=float(interval or 10))
+        elif kind == 'prometheus':
+            self.enable(PrometheusSink(port=int(rest or DEFAULT_METRICS_PORT)))
+        else:
+            raise ValueError(f'Unknown metrics sink: {spec}')
+
+
+class JsonLinesSink:
+    '''
+    Appends each snapshot to a file as one line of JSON
+    '''
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+
+    def write(self, snapshot):
+        line = json.dumps(dict(snapshot, time=time.time()))
+        with self._lock:
+            with open(self._path, 'a') as f:
+                f.write(line + '\n')
+
+    def close(self):
+        pass
+
+
+def prometheusText(snapshot):
+    '''
+    Render a snapshot in the Prometheus text exposition format
+    '''
+    def metricName(name):
+        return 'curator_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append(f'# TYPE {metricName(name)}_total counter')
+        lines.append(f'{metricName(name)}_total {value}')
+    for name, value in sorted(snapshot['gauges'].items()):
+        lines.append(f'# TYPE {metricName(name)} gauge')
+        lines.append(f'{metricName(name)} {value}')
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        lines.append(f'# TYPE {metricName(name)} histogram')
+        cumulative = 0
+        for bound, count in histogram['buckets']:
+            cumulative += count
+            lines.append(f'{metricName(name)}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{metricName(name)}_bucket{{le="+Inf"}} {histogram["count"]}')
+        lines.append(f'{metricName(name)}_sum {histogram["sum"]}')
+        lines.append(f'{metricName(name)}_count {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusSink:
+    '''
+    Serves the current metrics at http://127.0.0.1:port/metrics for a
+    Prometheus scraper. Nothing is pushed, so write() has nothing to do.
+    '''
+    def __init__(self, port=DEFAULT_METRICS_PORT, metrics=None, host='127.0.0.1'):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # only needed for this sink
+        source = metrics
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = prometheusText((source or METRICS).snapshot()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name='metrics-http', daemon=True).start()
+
+    def write(self, snapshot):
+        pass
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+# The metrics for this process, off until enabled
+METRICS = Metrics()
+
+
+# Fields of a favorite in a .curator file, in ArtObject constructor order
+FAVORITE_FIELDS = ('objectId', 'title', 'artist', 'date', 'nationality', 'medium', 'imageUrl')
+_JSON_SPACE = re.compile(r'\s*')
+
+def readFavorites(file, chunkSize=FAVORITES_CHUNK_SIZE):
+    '''
+    Yield the records of a .curator file (a JSON array of objects) one at a
+    time, reading the file in chunks instead of loading it whole
+    '''
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    expect = '['
+    while True:
+        position = _JSON_SPACE.match(buffer, position).end()
+        if position == len(buffer) and not eof:
+            buffer = file.read(chunkSize)
+            position = 0
+            eof = not buffer
+            continue
+        if position == len(buffer):
+            raise ValueError('favorites file ends before its closing ]')
+        if expect == '[':
+            if buffer[position] != '[':
+                raise ValueError('favorites file is not a JSON array')
+            position += 1
+            expect = 'first'
+        elif expect in ('first', ',') and buffer[position] == ']':
+            return
+        elif expect == ',':
+            if buffer[position] != ',':
+                raise ValueError(f'expected , in favorites file, found {buffer[position]!r}')
+            position += 1
+            expect = 'value'
+        else:
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # most likely a record cut off at the end of the chunk
+                if eof:
+                    raise
+                chunk = file.read(chunkSize)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            expect = ','
+            yield record
+
+def writeFavorites(file, artObjects):
+    '''
+    Write artObjects to file as a .curator JSON array, one record at a time.
+    Returns the number written.
+    '''
+    count = 0
+    file.write('[')
+    for artObject in artObjects:
+        record = json.dumps(artObject.toDict(), sort_keys=True, indent=4)
+        file.write(',\n' if count else '\n')
+        file.write('\n'.join('    ' + line for line in record.splitlines()))
+        count += 1
+    file.write('\n]' if count else ']')
+    return count
+
+
 class User:
-    def __init__(self, name):
+    '''
+    A user and their favorites, indexed in memory by favoriteKey(). Changes
+    are written behind: only the dirty entries reach the Database, shortly
+    after the change or on flush().
+    '''
+    def __init__(self, name, flushDelay=DEFAULT_FAVORITES_FLUSH_DELAY, load=True):
         self._name = name
-        self._favorites = []
-        self.loadFavorites()
+        self._favorites = {}
+        self._dirty = {}
+        self._flushDelay = flushDelay
+        self._flushTimer = None
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        # load=False leaves loadFavorites() to the caller, e.g. on a worker
+        if load:
+            self.loadFavorites()
         logging.debug(("created user: " + self._name + " with " + str(len(self._favorites)) + " items"))
 
     def getName(self):
         return self._name
 
     def loadFavorites(self):
-        __db = Database(DB_PATH)
-        self._favorites = __db.getFavorites(self)
-        if self._favorites == None:
-            self._favorites = []
-        del __db
+        favorites = Database(DB_PATH).getFavorites(self)
+        with self._lock:
+            self._favorites = {favoriteKey(f.objectId): f for f in favorites}
+            # changes not yet flushed win over what is on disk
+            for key, artObject in self._dirty.items():
+                if artObject is None:
+                    self._favorites.pop(key, None)
+                else:
+                    self._favorites[key] = artObject
 
     def saveFavorites(self):
-        for artObject in self._favorites:
-            artObject.save(self)
+        self.flush()
 
     def getFavorites(self):
-        self.loadFavorites()
-        return self._favorites
+        with self._lock:
+            favorites = list(self._favorites.values())
+        favorites.sort(key=lambda f: f.title)
+        return favorites
 
     def addFavorite(self, artObject):
-        if not self.isFavorite(artObject.objectId):
+        key = favoriteKey(artObject.objectId)
+        with self._lock:
+            if key in self._favorites:
+                logging.debug(f'Art object {artObject.objectId} is already a favorite')
+                return
             logging.debug(f'Adding favorite with ID {artObject.objectId}')
-            self._favorites.append(artObject)
-
-            # Save favorites whenever a new one is added.
-            self.saveFavorites()
-        else:
-            logging.debug(f'Art object {artObject.objectId} is already a favorite')
+            self._favorites[key] = artObject
+            self._dirty[key] = artObject
+        self._scheduleFlush()
 
     def removeFavorite(self, artObject):
-        artObject.remove(self)
-        self.loadFavorites()
+        key = favoriteKey(artObject.objectId)
+        with self._lock:
+            self._favorites.pop(key, None)
+            # None marks a row to delete
+            self._dirty[key] = None
+        self._scheduleFlush()
 
     def isFavorite(self, objectId):
-        for f in self._favorites:
-            # artObject IDs from query are int, those from db are str - convert 
-            # to str before check
-            if f.objectId == str(objectId):
-                return True
-        return False
+        return favoriteKey(objectId) in self._favorites
+
+    def _scheduleFlush(self):
+        with self._lock:
+            if self._flushTimer is not None:
+                return
+            self._flushTimer = threading.Timer(self._flushDelay, self.flush)
+            self._flushTimer.daemon = True
+            self._flushTimer.start()
+
+    def flush(self):
+        '''
+        Write the dirty favorites to the Database in one transaction
+        '''
+        with self._flushLock:
+            with self._lock:
+                if self._flushTimer is not None:
+                    self._flushTimer.cancel()
+                    self._flushTimer = None
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+            saved = [artObject for artObject in dirty.values() if artObject is not None]
+            removed = [ArtObject(key, '', '', '', '', '', '') for key, artObject in dirty.items() if artObject is None]
+            try:
+                __db = Database(DB_PATH)
+                with METRICS.timer('favorites.flush.seconds'), __db.transaction():
+                    __db.upsertArtObjects(self, saved)
+                    __db.removeArtObjects(self, removed)
+            except Exception:
+                # put them back for the next flush unless changed meanwhile
+                with self._lock:
+                    for key, artObject in dirty.items():
+                        self._dirty.setdefault(key, artObject)
+                raise
+            METRICS.increment('favorites.flushed', len(dirty))
+            METRICS.setGauge('favorites.count', len(self._favorites))
+            logging.debug(f'Flushed {len(dirty)} favorites for {self._name}')
+
+    def importFavorites(self, file):
+        '''
+        Add every favorite in a .curator file that isn't one already. The
+        file is streamed and the new rows are written in one transaction.
+        Returns the ArtObjects that were added.
+        '''
+        self.flush()
+        with self._lock:
+            known = set(self._favorites)
+        added = []
+        for record in readFavorites(file):
+            key = favoriteKey(record['objectId'])
+            if key in known:
+                continue
+            known.add(key)
+            added.append(ArtObject(*(record.get(field, '') for field in FAVORITE_FIELDS)))
+        __db = Database(DB_PATH)
+        with __db.transaction():
+            __db.upsertArtObjects(self, added)
+        with self._lock:
+            for artObject in added:
+                self._favorites[favoriteKey(artObject.objectId)] = artObject
+        logging.debug(f'Imported {len(added)} favorites for {self._name}')
+        return added
+
+    def exportFavorites(self, file):
+        '''
+        Write the favorites to a .curator file, returns the number written
+        '''
+        return writeFavorites(file, self.getFavorites())
+
+
+class FetchError(Exception):
+    ''' A museum request that still failed after any retries '''
+    def __init__(self, message, url=None):
+        super().__init__(message)
+        self.url = url
+
+
+class RateLimiter:
+    '''
+    Token bucket shared by every request to one host, across all sessions
+    and Query instances. The rate halves on 429/503 responses (pausing for
+    any Retry-After) and creeps back up with each success.
+    '''
+    _limiters = {}
+    _limitersLock = threading.Lock()
+
+    @classmethod
+    def forHost(cls, host):
+        with cls._limitersLock:
+            limiter = cls._limiters.get(host)
+            if limiter is None:
+                limiter = cls()
+                cls._limiters[host] = limiter
+            return limiter
+
+    @classmethod
+    def setForHost(cls, host, limiter):
+        # e.g. to give a local test server a different rate, None restores
+        # the default
+        with cls._limitersLock:
+            if limiter is None:
+                cls._limiters.pop(host, None)
+            else:
+                cls._limiters[host] = limiter
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, burst=DEFAULT_RATE_BURST, minRate=1.0, increase=0.1):
+        self._rate = float(rate)
+        self._maxRate = float(rate)
+        self._minRate = minRate
+        self._burst = burst
+        self._increase = increase
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._pausedUntil = 0.0
+        self._lastDecrease = 0.0
+        self._lock = threading.Lock()
+        self._stats = {'throttled': 0, 'waits': 0, 'secondsWaited': 0.0}
+
+    def getRate(self):
+        with self._lock:
+            return self._rate
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['rate'] = self._rate
+            return stats
+
+    def reserve(self):
+        '''
+        Take a token and return how many seconds the caller must wait
+        before using it
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            # tokens may go negative, later callers queue up behind the debt
+            self._tokens -= 1
+            delay = max(-self._tokens / self._rate, self._pausedUntil - now, 0.0)
+            if delay > 0:
+                self._stats['waits'] += 1
+                self._stats['secondsWaited'] += delay
+            return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquireAsync(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def onThrottled(self, retryAfter=None):
+        with self._lock:
+            now = time.monotonic()
+            self._stats['throttled'] += 1
+            # a burst of 429s from requests already in flight is one signal
+            if now - self._lastDecrease >= 1.0:
+                self._rate = max(self._minRate, self._rate / 2)
+                self._lastDecrease = now
+            if retryAfter:
+                self._pausedUntil = max(self._pausedUntil, now + retryAfter)
+            self._tokens = min(self._tokens, 0.0)
+
+    def onSuccess(self):
+        with self._lock:
+            self._rate = min(self._maxRate, self._rate + self._increase)
+
+
+def _recordRequest(started, response, error):
+    # request metrics shared by both fetch engines
+    if not METRICS.isEnabled():
+        return
+    METRICS.observe('http.request.seconds', time.perf_counter() - started)
+    if response is None:
+        METRICS.increment('http.errors')
+        return
+    METRICS.increment(f'http.status.{response.status_code}')
+    METRICS.observe('http.response.bytes', len(response.content), BYTES_BUCKETS)
+
+
+def _retryAfterSeconds(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime # only needed for dated Retry-After
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    '''
+    Classifies each response, counts the outcomes and decides whether to
+    retry: throttled (429/503), other 5xx and dropped connections are
+    retried with jittered exponential backoff, honouring Retry-After
+    '''
+    RETRIED = ('throttled', 'serverError', 'connectionError')
+
+    def __init__(self, maxRetries=DEFAULT_MAX_RETRIES, backoffBase=BACKOFF_BASE, backoffCap=BACKOFF_CAP):
+        self._maxRetries = maxRetries
+        self._backoffBase = backoffBase
+        self._backoffCap = backoffCap
+        self._lock = threading.Lock()
+        self._stats = {'ok': 0, 'notModified': 0, 'throttled': 0, 'serverError': 0, 'clientError': 0, 'connectionError': 0, 'retries': 0, 'gaveUp': 0}
+
+    def getStats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def outcome(self, response):
+        status = response.status_code
+        if status == 304:
+            return 'notModified'
+        if status in (429, 503):
+            return 'throttled'
+        if status >= 500:
+            return 'serverError'
+        if status >= 400:
+            return 'clientError'
+        return 'ok'
+
+    def review(self, attempt, limiter, response=None, error=None):
+        '''
+        Record how a request went and return the seconds to wait before
+        retrying it, or None when the caller should stop there
+        '''
+        retryAfter = None
+        if error is not None:
+            outcome = 'connectionError'
+        else:
+            outcome = self.outcome(response)
+            retryAfter = _retryAfterSeconds(response.headers.get('Retry-After'))
+        self._count(outcome)
+        if outcome == 'throttled':
+            limiter.onThrottled(retryAfter)
+        elif outcome in ('ok', 'notModified'):
+            limiter.onSuccess()
+        if outcome not in self.RETRIED:
+            return None
+        if attempt >= self._maxRetries:
+            self._count('gaveUp')
+            return None
+        self._count('retries')
+        backoff = random.uniform(0, min(self._backoffCap, self._backoffBase * 2 ** attempt))
+        return max(backoff, retryAfter or 0.0)
+
+
+class HttpSession:
+    '''
+    Shared keep-alive HTTP session used for all museum REST calls.
+    Connections are pooled per host, so repeated object lookups reuse an open
+    TCP/TLS connection instead of performing a new handshake each time.
+    Requests wait on the host's shared RateLimiter and are retried according
+    to retryPolicy.
+    '''
+    def __init__(self, poolSize=DEFAULT_MAX_WORKERS, maxHosts=4, timeout=DEFAULT_TIMEOUT, blockWhenFull=True, retryPolicy=None):
+        import requests # used for rest
+        from requests.adapters import HTTPAdapter # used to size the connection pool
+        self._timeout = timeout
+        self._retryPolicy = retryPolicy or RetryPolicy()
+        self._transientErrors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        # pool_maxsize is the per-host connection limit, pool_connections the
+        # number of hosts kept open at once
+        self._adapter = HTTPAdapter(
+            pool_connections=maxHosts,
+            pool_maxsize=poolSize,
+            pool_block=blockWhenFull
+        )
+        self._session = requests.Session()
+        self._session.mount('https://', self._adapter)
+        self._session.mount('http://', self._adapter)
+        self._session.headers.update({'Connection': 'keep-alive'})
+        self._lock = threading.Lock()
+        self._requestCount = 0
+        logging.debug(f'HttpSession created with pool size {poolSize}')
+
+    def get(self, url, headers=None):
+        limiter = RateLimiter.forHost(urlsplit(url).netloc)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            response = None
+            error = None
+            started = time.perf_counter()
+            try:
+                response = self._session.get(url, headers=headers, timeout=self._timeout)
+            except self._transientErrors as e:
+                error = e
+            _recordRequest(started, response, error)
+            with self._lock:
+                self._requestCount += 1
+            delay = self._retryPolicy.review(attempt, limiter, response, error)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            logging.debug(f'Retrying {url} in {delay:.2f}s')
+            time.sleep(delay)
+            attempt += 1
+
+    def getTimeout(self):
+        return self._timeout
+
+    def getStats(self):
+        '''
+        Report how many requests were served and how many of them reused an
+        already open connection
+        '''
+        opened = 0
+        served = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            served += pool.num_requests
+        with self._lock:
+            requestCount = self._requestCount
+        return {
+            'requests': requestCount,
+            'connectionsOpened': opened,
+            'connectionsReused': max(served - opened, 0),
+            'outcomes': self._retryPolicy.getStats(),
+        }
+
+    def close(self):
+        self._session.close()
+
+
+class AsyncFetcher:
+    '''
+    asyncio fetch engine: runs every lookup on a single event loop, with a
+    semaphore bounding the number of requests in flight at once. Requests
+    share each host's RateLimiter and are retried according to retryPolicy.
+    '''
+    def __init__(self, maxConcurrency=DEFAULT_MAX_CONCURRENCY, http2=False, timeout=DEFAULT_TIMEOUT, retryPolicy=None):
+        try:
+            import httpx # optional, async HTTP client for the asyncio fetch engine
+        except ImportError:
+            raise ImportError("the async engine requires the 'httpx' package")
+        self._httpx = httpx
+        self._retryPolicy = retryPolicy or RetryPolicy()
+        self._maxConcurrency = maxConcurrency
+        self._http2 = http2
+        self._timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        # the event loop thread and its client are started on first use
+        self._loopLock = threading.Lock()
+        self._loop = None
+        self._loopThread = None
+        self._executor = None
+        self._client = None
+        self._semaphore = None
+
+    def getMaxConcurrency(self):
+        return self._maxConcurrency
+
+    def _newClient(self):
+        httpx = self._httpx
+        limits = httpx.Limits(
+            max_connections=self._maxConcurrency,
+            max_keepalive_connections=self._maxConcurrency
+        )
+        try:
+            return httpx.AsyncClient(http2=self._http2, limits=limits, timeout=self._timeout)
+        except ImportError:
+            # HTTP/2 needs the 'h2' package, fall back to HTTP/1.1 keep-alive
+            logging.info('h2 not installed, async engine using HTTP/1.1')
+            return httpx.AsyncClient(limits=limits, timeout=self._timeout)
+
+    def getStats(self):
+        return {'outcomes': self._retryPolicy.getStats()}
+
+    async def _fetch(self, client, semaphore, url, headers):
+        limiter = RateLimiter.forHost(urlsplit(url).netloc)
+        attempt = 0
+        async with semaphore:
+            while True:
+                await limiter.acquireAsync()
+                response = None
+                error = None
+                started = time.perf_counter()
+                try:
+                    response = await client.get(url, headers=headers)
+                except self._httpx.TransportError as e:
+                    error = e
+                _recordRequest(started, response, error)
+                delay = self._retryPolicy.review(attempt, limiter, response, error)
+                if delay is None:
+                    if error is not None:
+                        # handed back in place of the response so one bad
+                        # request doesn't end the whole stream
+                        return FetchError(f'{url}: {error}', url)
+                    return response
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def _startLoop(self):
+        # one event loop and one client for the fetcher's lifetime, so every
+        # stream shares the client's open connections
+        with self._loopLock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                # settle() callbacks run here, owned so close() can stop them
+                self._executor = ThreadPoolExecutor(thread_name_prefix='curator-settle')
+                loop.set_default_executor(self._executor)
+                thread = threading.Thread(target=loop.run_forever, name='curator-async', daemon=True)
+                thread.start()
+
+                async def setUp():
+                    self._client = self._newClient()
+                    self._semaphore = asyncio.Semaphore(self._maxConcurrency)
+                asyncio.run_coroutine_threadsafe(setUp(), loop).result()
+                self._loop = loop
+                self._loopThread = thread
+            return self._loop
+
+    async def stream(self, requestList, ordered=False, settle=None):
+        '''
+        Async iterator over the responses for a list of (url, headers)
+        requests, in completion order or in request order when ordered is True.
+        Requests that could not be completed yield a FetchError instead.
+        With settle, settle(index, response) is run on a worker thread as each
+        response arrives and its result is yielded in place of the response.
+        Runs on the fetcher's own loop, see iterate().
+        '''
+        loop = asyncio.get_running_loop()
+
+        async def fetch(index, url, headers):
+            response = await self._fetch(self._client, self._semaphore, url, headers)
+            if settle is None:
+                return response
+            return await loop.run_in_executor(None, settle, index, response)
+
+        tasks = [asyncio.ensure_future(fetch(index, url, headers)) for index, (url, headers) in enumerate(requestList)]
+        try:
+            for task in (tasks if ordered else asyncio.as_completed(tasks)):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def iterate(self, requestList, ordered=False, settle=None):
+        '''
+        Blocking generator over stream(), run on the fetcher's event loop
+        thread. The requests are started straight away.
+        '''
+        loop = self._startLoop()
+        results = queue.Queue()
+
+        async def pump():
+            try:
+                async for response in self.stream(requestList, ordered, settle):
+                    results.put(response)
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(END_OF_RESULTS)
+
+        def drain():
+            try:
+                # primed below, so closing the stream always cancels the pump
+                yield
+                while True:
+                    item = results.get()
+                    if item is END_OF_RESULTS:
+                        break
+                    if isinstance(item, Exception) and not isinstance(item, FetchError):
+                        raise item
+                    yield item
+            finally:
+                # stops outstanding requests if the caller stops iterating early
+                pumping.cancel()
+
+        # the requests start now rather than on the first next(), so settle()
+        # runs even while the caller is busy waiting on something else
+        pumping = asyncio.run_coroutine_threadsafe(pump(), loop)
+        stream = drain()
+        next(stream)
+        return stream
+
+    def close(self):
+        '''
+        Close the client and stop the event loop
+        '''
+        with self._loopLock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._loopThread.join()
+        loop.close()
+        self._executor.shutdown()
+        self._client = None
+        self._executor = None
+
+
+def canonicalParameters(parameters):
+    '''
+    Canonical string form of a set of search parameters: sorted keys,
+    booleans as lowercase true/false and whitespace collapsed
+    '''
+    canonical = []
+    for name in sorted(parameters):
+        value = parameters[name]
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        value = ' '.join(str(value).split())
+        if value.lower() in ('true', 'false'):
+            value = value.lower()
+        canonical.append((name.strip(), value))
+    return urlencode(canonical)
+
+
+def _isTrue(value):
+    return str(value).strip().lower() == 'true'
+
+
+class SearchCache:
+    '''
+    /search responses keyed on canonicalParameters(), kept in an in-memory
+    LRU backed by a table in the Database
+    '''
+    def __init__(self, ttl=DEFAULT_SEARCH_TTL, maxEntries=DEFAULT_SEARCH_CACHE_SIZE):
+        self._ttl = ttl
+        self._maxEntries = maxEntries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'diskHits': 0, 'misses': 0, 'evictions': 0}
+
+    def getStats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _remember(self, key, objectIds, fetchedAt):
+        # caller holds self._lock
+        self._entries[key] = (objectIds, fetchedAt)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxEntries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] < self._ttl:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return list(entry[0])
+        entry = Database(DB_PATH).getCachedSearch(key)
+        with self._lock:
+            if entry is not None and now - entry[1] < self._ttl:
+                objectIds = json.loads(entry[0])
+                self._remember(key, objectIds, entry[1])
+                self._stats['diskHits'] += 1
+                return list(objectIds)
+            self._stats['misses'] += 1
+        return None
+
+    def put(self, key, objectIds):
+        fetchedAt = time.time()
+        objectIds = list(objectIds)
+        with self._lock:
+            self._remember(key, objectIds, fetchedAt)
+        Database(DB_PATH).putCachedSearch(key, json.dumps(objectIds), fetchedAt)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SingleFlight:
+    '''
+    Coalesces concurrent calls for the same key: the first caller does the
+    work and any caller arriving while it is in flight shares its result
+    or exception
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> Future for the call in flight
+        self._calls = {}
+        self._stats = {'calls': 0, 'executed': 0, 'coalesced': 0}
+
+    def getStats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def claim(self, key):
+        '''
+        Join the call in flight for key, or lead it when there is none.
+        Returns (future, leader); a leader must settle() or abandon() future.
+        '''
+        with self._lock:
+            self._stats['calls'] += 1
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self._stats['executed'] += 1
+            else:
+                self._stats['coalesced'] += 1
+            return future, leader
+
+    def settle(self, key, future, work):
+        '''
+        Run a leader's work and share its result or exception
+        '''
+        try:
+            result = work()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def abandon(self, key, future, error):
+        # for a leader that won't do its work after all
+        self._finish(key, future, error=error)
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+            if future.done():
+                # already abandoned
+                return
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def do(self, key, work):
+        future, leader = self.claim(key)
+        if not leader:
+            return future.result()
+        return self.settle(key, future, work)
+
+
+class ObjectCache:
+    '''
+    Local copy of /objects/{id} responses kept in the Database. Fresh
+    entries are served without a network call and stale entries are
+    revalidated with a conditional request (ETag / Last-Modified).
+    Concurrent fetches of one object share a single request.
+    '''
+    def __init__(self, ttl=DEFAULT_OBJECT_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'revalidated': 0}
+        self._inFlight = SingleFlight()
+
+    def _db(self):
+        return Database(DB_PATH)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+        METRICS.increment(f'cache.object.{name}')
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['coalesced'] = self._inFlight.getStats()['coalesced']
+        return stats
+
+    def getInFlight(self):
+        return self._inFlight
+
+    def lookup(self, objectId):
+        '''
+        Returns (record, headers): the cached record if it is still fresh,
+        otherwise None and the headers for a conditional request
+        '''
+        entry = self._db().getCachedObject(objectId)
+        if entry is None:
+            return None, {}
+        jsonText, fetchedAt, etag, lastModified = entry
+        if time.time() - fetchedAt < self._ttl:
+            self._count('hits')
+            return json.loads(jsonText), {}
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if lastModified:
+            headers['If-Modified-Since'] = lastModified
+        return None, headers
+
+    def resolve(self, objectId, response):
+        '''
+        Returns the record for a response to a (possibly conditional)
+        request, refreshing the cache along the way
+        '''
+        if isinstance(response, FetchError):
+            raise response
+        db = self._db()
+        if response.status_code == 304:
+            entry = db.getCachedObject(objectId)
+            if entry is not None:
+                self._count('revalidated')
+                db.touchCachedObject(objectId, time.time())
+                return json.loads(entry[0])
+        self._count('misses')
+        if response.status_code != 200:
+            raise FetchError(f'Object {objectId} failed with HTTP {response.status_code}', str(response.url))
+        with METRICS.timer('cache.object.parse.seconds'):
+            record = json.loads(response.text)
+        db.putCachedObject(
+            objectId,
+            response.text,
+            time.time(),
+            response.headers.get('ETag'),
+            response.headers.get('Last-Modified')
+        )
+        return record
+
+    def fetch(self, session, objectId, url):
+        record, headers = self.lookup(objectId)
+        if record is not None:
+            return record
+        return self._inFlight.do(str(objectId), lambda: self.resolve(objectId, session.get(url, headers=headers)))
+
+
+class ImageCache:
+    '''
+    Images stored on disk under a hash of their URL within a byte budget,
+    evicting the least recently used files, plus an in-memory LRU of
+    decoded (and thumbnailed) PIL images. Concurrent downloads of one URL
+    share a single request.
+    '''
+    def __init__(self, session, cacheDir=IMAGE_CACHE_DIR, maxBytes=DEFAULT_IMAGE_CACHE_BYTES, maxDecoded=DEFAULT_DECODED_IMAGES):
+        self._session = session
+        self._cacheDir = cacheDir
+        self._maxBytes = maxBytes
+        self._maxDecoded = maxDecoded
+        self._lock = threading.Lock()
+        # file name -> size in bytes, least recently used first
+        self._files = OrderedDict()
+        self._bytes = 0
+        # (url, size) -> decoded PIL image, least recently used first
+        self._decoded = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'decodedHits': 0, 'evictions': 0, 'bytesDownloaded': 0}
+        self._inFlight = SingleFlight()
+        os.makedirs(cacheDir, exist_ok=True)
+        self._scanDisk()
+
+    def _scanDisk(self):
+        # rebuild the LRU order from the files' last access (mtime) times
+        entries = []
+        for name in os.listdir(self._cacheDir):
+            path = os.path.join(self._cacheDir, name)
+            if os.path.isfile(path) and not name.endswith('.tmp'):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(entries):
+            self._files[name] = size
+            self._bytes += size
+        self._evict()
+
+    def _nameFor(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _evict(self):
+        # caller holds self._lock (or is the constructor)
+        while self._bytes > self._maxBytes and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self._bytes -= size
+            self._stats['evictions'] += 1
+            try:
+                os.remove(os.path.join(self._cacheDir, name))
+            except OSError:
+                pass
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['bytes'] = self._bytes
+            stats['files'] = len(self._files)
+            stats['decoded'] = len(self._decoded)
+        stats['coalesced'] = self._inFlight.getStats()['coalesced']
+        return stats
+
+    def getBytes(self, url):
+        '''
+        Return the image bytes for url, downloading them on a cache miss
+        '''
+        name = self._nameFor(url)
+        path = os.path.join(self._cacheDir, name)
+        with self._lock:
+            cached = name in self._files
+            if cached:
+                self._files.move_to_end(name)
+        if cached:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+                with self._lock:
+                    self._stats['hits'] += 1
+                METRICS.increment('cache.image.hits')
+                return data
+            except OSError:
+                with self._lock:
+                    self._bytes -= self._files.pop(name, 0)
+        # the viewer and the prefetcher often want the same image at once
+        return self._inFlight.do(url, lambda: self._download(url, name, path))
+
+    def _download(self, url, name, path):
+        response = self._session.get(url)
+        response.raise_for_status()
+        data = response.content
+        # write to a temporary name first so readers never see partial files
+        tmpPath = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(data)
+        os.replace(tmpPath, path)
+        with self._lock:
+            self._bytes += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            self._stats['misses'] += 1
+            self._stats['bytesDownloaded'] += len(data)
+            self._evict()
+        METRICS.increment('cache.image.misses')
+        return data
+
+    def contains(self, url):
+        with self._lock:
+            return self._nameFor(url) in self._files
+
+    def getImage(self, url, size=None):
+        '''
+        Return the decoded image for url, reduced to fit size (width, height)
+        when given. The returned image is shared and must not be modified.
+        '''
+        key = (url, size)
+        with self._lock:
+            image = self._decoded.get(key)
+            if image is not None:
+                self._decoded.move_to_end(key)
+                self._stats['decodedHits'] += 1
+                return image
+        from PIL import Image # used to decode images, only needed here
+        image = Image.open(io.BytesIO(self.getBytes(url)))
+        if size and size[0] > 0 and size[1] > 0:
+            # JPEG draft mode decodes straight to a reduced scale (1/2 .. 1/8)
+            # that is still at least as large as size, before the final resize
+            if image.format == 'JPEG':
+                image.draft('RGB', size)
+            image.thumbnail(size)
+        image.load()
+        with self._lock:
+            self._decoded[key] = image
+            while len(self._decoded) > self._maxDecoded:
+                self._decoded.popitem(last=False)
+        return image
+
+
+class ImagePrefetcher:
+    '''
+    Warms an ImageCache in the background with images the user is likely
+    to look at next, within a worker and download-rate budget. cancel()
+    drops everything still queued, e.g. when a new search starts.
+    '''
+    def __init__(self, imageCache, maxWorkers=DEFAULT_PREFETCH_WORKERS, maxBytesPerSecond=DEFAULT_PREFETCH_BYTES_PER_SECOND):
+        self._imageCache = imageCache
+        self._maxBytesPerSecond = maxBytesPerSecond
+        self._executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        self._lock = threading.Lock()
+        self._generation = 0
+        # (url, size) -> Future for prefetches not yet finished
+        self._pending = {}
+        # earliest time the next download may start under the byte budget
+        self._nextSlot = 0.0
+        self._stats = {'queued': 0, 'completed': 0, 'cancelled': 0, 'failed': 0}
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        return stats
+
+    def prefetch(self, urls, size=None):
+        submitted = []
+        with self._lock:
+            generation = self._generation
+            for url in urls:
+                key = (url, size)
+                if not url or key in self._pending:
+                    continue
+                future = self._executor.submit(self._fetch, url, size, generation)
+                self._pending[key] = future
+                self._stats['queued'] += 1
+                submitted.append((key, future))
+        # callbacks run immediately for finished futures, so add them unlocked
+        for key, future in submitted:
+            future.add_done_callback(lambda f, key=key: self._done(key, f))
+
+    def wait(self, timeout=None):
+        '''
+        Block until the prefetches queued so far have finished
+        '''
+        with self._lock:
+            pending = list(self._pending.values())
+        waitForFutures(pending, timeout)
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def _waitForBandwidth(self):
+        if not self._maxBytesPerSecond:
+            return
+        with self._lock:
+            delay = self._nextSlot - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _chargeBandwidth(self, byteCount):
+        if not self._maxBytesPerSecond:
+            return
+        with self._lock:
+            self._nextSlot = max(time.time(), self._nextSlot) + byteCount / self._maxBytesPerSecond
+
+    def _fetch(self, url, size, generation):
+        if generation != self._generation:
+            with self._lock:
+                self._stats['cancelled'] += 1
+            return
+        try:
+            if not self._imageCache.contains(url):
+                self._waitForBandwidth()
+                if generation != self._generation:
+                    with self._lock:
+                        self._stats['cancelled'] += 1
+                    return
+                self._chargeBandwidth(len(self._imageCache.getBytes(url)))
+            self._imageCache.getImage(url, size)
+        except Exception as e:
+            logging.debug(f'Prefetch of {url} failed. {str(e)}')
+            with self._lock:
+                self._stats['failed'] += 1
+            return
+        with self._lock:
+            self._stats['completed'] += 1
+
+    def cancel(self):
+        with self._lock:
+            self._generation += 1
+            for future in self._pending.values():
+                if future.cancel():
+                    self._stats['cancelled'] += 1
+            self._pending.clear()
+
+    def close(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+
+class LocalCollection:
+    '''
+    Answers Query parameters from the local mirror of MetObjects.csv that
+    parse_to_sql.py builds, so searches and object details need no REST
+    calls. The CSV has no image URLs; those come from the object cache.
+    '''
+    def _db(self):
+        return Database(DB_PATH)
+
+    def isAvailable(self):
+        return self._db().mirrorExists()
+
+    def search(self, parameters):
+        '''
+        Return the object IDs matching parameters, as /search would
+        '''
+        clauses = []
+        values = []
+        q = ' '.join(str(parameters.get('q', '')).split())
+        if q and q != '*':
+            phrase = '"' + q.replace('"', '""') + '"'
+            if _isTrue(parameters.get('title')):
+                phrase = 'title : ' + phrase
+            elif _isTrue(parameters.get('artistOrCulture')):
+                phrase = 'artist : ' + phrase
+            clauses.append('objectId IN (SELECT rowid FROM mirrorObjectsFts WHERE mirrorObjectsFts MATCH ?)')
+            values.append(phrase)
+        try:
+            departmentId = int(parameters.get('departmentId', 0))
+        except ValueError:
+            departmentId = 0
+        if departmentId > 0:
+            clauses.append('departmentId = ?')
+            values.append(departmentId)
+        if parameters.get('classification'):
+            clauses.append('classification = ? COLLATE NOCASE')
+            values.append(parameters['classification'])
+        if _isTrue(parameters.get('isOnView')):
+            clauses.append('isOnView = 1')
+        if _isTrue(parameters.get('isHighlight')):
+            clauses.append('isHighlight = 1')
+        try:
+            dates = [int(parameters['dateBegin']), int(parameters['dateEnd'])]
+        except (KeyError, TypeError, ValueError):
+            # no date range, or one that's still being typed
+            dates = None
+        if dates:
+            clauses.append('beginDate >= ? AND endDate <= ?')
+            values.extend(dates)
+        if parameters.get('geoLocation'):
+            clauses.append('(country = ? COLLATE NOCASE OR city = ? COLLATE NOCASE OR region = ? COLLATE NOCASE)')
+            values.extend([parameters['geoLocation']] * 3)
+        if parameters.get('medium'):
+            clauses.append('medium LIKE ?')
+            values.append('%' + parameters['medium'] + '%')
+        return self._db().searchMirror(' AND '.join(clauses), values)
+
+    def getRecords(self, objectIds):
+        '''
+        Return {str(objectId): record} for the mirrored objects, with records
+        shaped like the /objects/{id} JSON
+        '''
+        db = self._db()
+        records = {}
+        for row in db.getMirrorObjects(objectIds):
+            imageUrl = ''
+            cached = db.getCachedObject(row[0])
+            if cached is not None:
+                imageUrl = json.loads(cached[0]).get('primaryImageSmall', '')
+            records[str(row[0])] = {
+                'objectID': row[0],
+                'title': row[1],
+                'artistDisplayName': row[2],
+                'objectDate': row[3],
+                'artistNationality': row[4],
+                'medium': row[5],
+                'primaryImageSmall': imageUrl,
+            }
+        return records
 
 
 class Museum:
-    def __init__(self, name, searchUrlBase, objectUrlBase):
+    def __init__(self, name, searchUrlBase, objectUrlBase, maxWorkers=DEFAULT_MAX_WORKERS, timeout=DEFAULT_TIMEOUT, maxConcurrency=DEFAULT_MAX_CONCURRENCY, http2=False, objectTtl=DEFAULT_OBJECT_TTL, searchTtl=DEFAULT_SEARCH_TTL):
         self._name = name
         self._searchUrlBase = searchUrlBase
         self._objectUrlBase = objectUrlBase
+        self._maxWorkers = maxWorkers
+        self._timeout = timeout
+        self._maxConcurrency = maxConcurrency
+        self._http2 = http2
+        self._asyncFetcher = None
+        # One pooled session per museum, sized so every fetch worker can hold
+        # its own keep-alive connection
+        self._session = HttpSession(poolSize=maxWorkers, timeout=timeout)
+        self._objectCache = ObjectCache(ttl=objectTtl)
+        self._searchCache = SearchCache(ttl=searchTtl)
+        self._localCollection = LocalCollection()
         # TODO retrieve departments using rest and store in db
-        self._departments = {
-            "American Decorative Arts" : 1,
-            "Ancient Near Eastern Art" : 3,
-            "Arms and Armor" : 4,
-            "Arts of Africa, Oceania, and the Americas" : 5,
-            "Asian Art" : 6,
-            "The Cloisters" : 7,
-            "The Costume Institute" : 8,
-            "Drawings and Prints" : 9,
-            "Egyptian Art" : 10,
-            "European Paintings" : 11,
-            "European Sculpture and Decorative Arts" : 12,
-            "Greek and Roman Art" : 13,
-            "Islamic Art" : 14,
-            "The Robert Lehman Collection" : 15,
-            "The Libraries" : 16,
-            "Medieval Art" : 17,
-            "Musical Instruments" : 18,
-            "Photographs" : 19,
-            "Modern Art" : 21,
-        }
+        self._departments = dict(DEPARTMENTS)
         self._geoLocations = [ "Europe", "France", "Paris", "China", "New York" ]
-        self._classifications = self.get_classifications()
+        # loaded on first use, building the table can mean downloading the
+        # whole collection CSV
+        self._classifications = None
+        self._classificationsLock = threading.Lock()
 
     def getSearchUrlBase(self):
         return self._searchUrlBase
@@ -101,6 +1560,35 @@ class Museum:
     def getObjectUrlBase(self):
         return self._objectUrlBase
 
+    def getSession(self):
+        return self._session
+
+    def getMaxWorkers(self):
+        return self._maxWorkers
+
+    def getSessionStats(self):
+        return self._session.getStats()
+
+    def getObjectCache(self):
+        return self._objectCache
+
+    def getSearchCache(self):
+        return self._searchCache
+
+    def getLocalCollection(self):
+        return self._localCollection
+
+    def getAsyncFetcher(self):
+        # created on first use so httpx is only needed by the async engine
+        if self._asyncFetcher is None:
+            self._asyncFetcher = AsyncFetcher(self._maxConcurrency, self._http2, self._timeout)
+        return self._asyncFetcher
+
+    def close(self):
+        self._session.close()
+        if self._asyncFetcher is not None:
+            self._asyncFetcher.close()
+
     def isValidParameter(self, key, value):
         #TODO: perform validation based on the Open Access API documentation
         return True
@@ -120,27 +1608,39 @@ class Museum:
         return self._geoLocations
 
     def getClassifications(self):
-        return self._classifications
+        with self._classificationsLock:
+            if self._classifications is None:
+                self._classifications = self.get_classifications()
+            return self._classifications
+
+    def refreshCollection(self, workers=1):
+        '''
+        Bring the classifications and the local collection mirror up to date
+        with a conditional download of the collection CSV, parsed by
+        workers processes
+        '''
+        import parse_to_sql # imported here, it is only needed to build the tables
+        status = parse_to_sql.refresh(DB_PATH, workers=workers)
+        if status != 'unchanged':
+            self._classifications = self.get_classifications()
+        return status
 
     def get_classifications(self):
         print("getting classifications")
-        conn=sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name='classifications' ''')
-        if cursor.fetchone()[0]==1 :
+        db = Database(DB_PATH)
+        if db.query(''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name='classifications' ''')[0][0]==1 :
             print('Table exists.')
             print("classifications")
         else:
             print("making classifications")
-            exec(open("parse_to_sql.py").read())
+            import parse_to_sql # imported here, it is only needed to build the tables
+            parse_to_sql.main(DB_PATH)
         query = ('''SELECT Classification FROM classifications;''')
         try:
-            cursor.execute(query)
-            rows =cursor.fetchall()
+            rows = db.query(query)
             temp = []
             for i in rows:
                 temp.append(i[0])
-            conn.commit()
             return temp
         except NameError:
             print(NameError)
@@ -148,13 +1648,35 @@ class Museum:
         
 
 class Query:
-    def __init__(self, museum):
+    def __init__(self, museum, engine=ENGINE_THREADED, backend=BACKEND_REMOTE):
         self._parameters = {}
         self._museum = museum
         self.setParameter("hasImage", "true")
         self.objectSet = []
-        self.resultSet = []
+        self.resultSet = ResultSet()
+        # IDs whose details could not be fetched, left out of resultSet
+        self.failedIds = []
         self.state = 'new'
+        self.setEngine(engine)
+        self.setBackend(backend)
+
+    def setBackend(self, backend):
+        # answer queries from the REST API or from the local collection mirror
+        if backend not in (BACKEND_REMOTE, BACKEND_LOCAL):
+            raise ValueError(f'Unknown query backend: {backend}')
+        self._backend = backend
+
+    def getBackend(self):
+        return self._backend
+
+    def setEngine(self, engine):
+        # switch between the threaded and asyncio engines for fetchArtObjects
+        if engine not in (ENGINE_THREADED, ENGINE_ASYNC):
+            raise ValueError(f'Unknown fetch engine: {engine}')
+        self._engine = engine
+
+    def getEngine(self):
+        return self._engine
 
     def setParameter(self, parameterName, parameterValue):
         logging.debug("Setting Paramater " + parameterName + ":" + parameterValue)
@@ -165,34 +1687,45 @@ class Query:
 
     def _fetchObjectIds(self):
         logging.debug('_fetchObjectIds started')
-        self.objectSet = []
-        queryPayload = {}
-        queryHeaders= {}
-        q = self._museum.getSearchUrlBase()
-        q = q + urlencode(self._parameters)
-        logging.debug(q)
-        response = requests.request("GET", q, headers=queryHeaders, data = queryPayload)
-        jsonResponse = response.json()
-        logging.debug("Rest query received " + str(len(jsonResponse)) + " matches")
-        logging.debug(str(jsonResponse))
-        if jsonResponse['objectIDs']:
-            for id in jsonResponse['objectIDs']:
-                self.objectSet.append(id)
+        if self._backend == BACKEND_LOCAL:
+            self.objectSet = self._museum.getLocalCollection().search(self._parameters)
+            return len(self.objectSet)
+        searchCache = self._museum.getSearchCache()
+        key = canonicalParameters(self._parameters)
+        objectIds = searchCache.get(key)
+        if objectIds is None:
+            METRICS.increment('query.search.cacheMisses')
+            q = self._museum.getSearchUrlBase()
+            q = q + urlencode(self._parameters)
+            logging.debug(q)
+            with METRICS.timer('query.search.seconds'):
+                response = self._museum.getSession().get(q)
+            if response.status_code != 200:
+                raise FetchError(f'Search failed with HTTP {response.status_code}', q)
+            jsonResponse = response.json()
+            logging.debug("Rest query received " + str(len(jsonResponse)) + " matches")
+            logging.debug(str(jsonResponse))
+            objectIds = jsonResponse['objectIDs'] or []
+            searchCache.put(key, objectIds)
+        else:
+            METRICS.increment('query.search.cacheHits')
+            logging.debug('Search served from cache')
+        self.objectSet = list(objectIds)
         return len(self.objectSet)
 
 
     def _fetchArtObject(self, id):
         logging.debug('_fetchArtObject started')
-        objectHeaders = {}
-        objectPayload = {}
-        objectResponse = requests.request(
-            "GET",
-            self._museum.getObjectUrlBase()+str(id),
-            headers=objectHeaders,
-            data=objectPayload
-            )
-        objectJsonResponse = objectResponse.json()
-        artObject = ArtObject(
+        with METRICS.timer('query.object.seconds'):
+            objectJsonResponse = self._museum.getObjectCache().fetch(
+                self._museum.getSession(),
+                id,
+                self._museum.getObjectUrlBase()+str(id)
+                )
+        return self._buildArtObject(objectJsonResponse)
+
+    def _buildArtObject(self, objectJsonResponse):
+        return ArtObject(
             objectJsonResponse['objectID'],
             objectJsonResponse['title'],
             objectJsonResponse['artistDisplayName'],
@@ -201,27 +1734,180 @@ class Query:
             objectJsonResponse['medium'],
             objectJsonResponse['primaryImageSmall']
         )
-        return(artObject)
+
+    def _skipFailed(self, id, error):
+        # one object that can't be fetched shouldn't cost the whole result set
+        logging.info(f'Skipping object {id}: {error}')
+        self.failedIds.append(id)
+
+    def _streamThreaded(self, objectIds, ordered):
+        executor = ThreadPoolExecutor(max_workers=self._museum.getMaxWorkers())
+        futures = {executor.submit(self._fetchArtObject, id): id for id in objectIds}
+        try:
+            for f in (futures if ordered else as_completed(futures)):
+                try:
+                    artObject = f.result()
+                except Exception as e:
+                    self._skipFailed(futures[f], e)
+                    continue
+                yield artObject
+        finally:
+            # stop outstanding lookups if the caller stops iterating early
+            for f in futures:
+                f.cancel()
+            executor.shutdown(wait=False)
+
+    def _streamAsync(self, objectIds, ordered):
+        # serve fresh cache hits directly, only the rest go to the event loop
+        cache = self._museum.getObjectCache()
+        flight = cache.getInFlight()
+        cached = {}
+        # objects another query is already fetching are waited for, the rest
+        # are claimed so other queries can wait for them in turn
+        pending = {}
+        leading = []
+        claimed = set()
+        requestList = []
+        for id in objectIds:
+            if id in cached or id in claimed:
+                # asked for twice, one lookup covers both
+                continue
+            record, headers = cache.lookup(id)
+            if record is not None:
+                cached[id] = record
+                continue
+            claimed.add(id)
+            future, leader = flight.claim(str(id))
+            if leader:
+                leading.append((id, future))
+                requestList.append((self._museum.getObjectUrlBase()+str(id), headers))
+            else:
+                pending[id] = future
+
+        def settle(index, response):
+            # runs as each response arrives, so the queries waiting for it
+            # don't depend on how fast this stream is consumed
+            id, future = leading[index]
+            try:
+                return id, flight.settle(str(id), future, lambda: cache.resolve(id, response))
+            except Exception as e:
+                return id, e
+
+        settled = self._museum.getAsyncFetcher().iterate(requestList, ordered, settle)
+        try:
+            if ordered:
+                # results arrive in request order, interleave them with the hits
+                fetched = {}
+                # a repeated ID's result is kept until its last occurrence
+                lastSeen = {id: index for index, id in enumerate(objectIds)}
+                for index, id in enumerate(objectIds):
+                    if id in cached:
+                        artObject = self._buildArtObject(cached[id])
+                    elif id in pending:
+                        artObject = self._sharedArtObject(id, pending[id])
+                    else:
+                        if id not in fetched:
+                            fetchedId, result = next(settled)
+                            fetched[fetchedId] = result
+                        result = fetched[id] if index < lastSeen[id] else fetched.pop(id)
+                        artObject = self._settledArtObject(id, result)
+                    if artObject is not None:
+                        yield artObject
+                return
+            # each object comes back as often as it was asked for
+            repeats = Counter(objectIds)
+            for id in cached:
+                artObject = self._buildArtObject(cached[id])
+                for i in range(repeats[id]):
+                    yield artObject
+            for id, result in settled:
+                artObject = self._settledArtObject(id, result)
+                if artObject is not None:
+                    for i in range(repeats[id]):
+                        yield artObject
+            for id, future in pending.items():
+                artObject = self._sharedArtObject(id, future)
+                if artObject is not None:
+                    for i in range(repeats[id]):
+                        yield artObject
+        finally:
+            settled.close()
+            # lookups this stream stopped before they finished
+            for id, future in leading:
+                flight.abandon(str(id), future, FetchError(f'Object {id} was not fetched'))
+
+    def _sharedArtObject(self, id, future):
+        try:
+            return self._buildArtObject(future.result())
+        except Exception as e:
+            self._skipFailed(id, e)
+            return None
+
+    def _settledArtObject(self, id, result):
+        if isinstance(result, Exception):
+            self._skipFailed(id, result)
+            return None
+        return self._buildArtObject(result)
+
+    def _streamLocal(self, objectIds, ordered):
+        # objects missing from the mirror, or whose image URL isn't known yet,
+        # are looked up remotely (through the object cache)
+        records = self._museum.getLocalCollection().getRecords(objectIds)
+        remoteIds = [id for id in objectIds if not records.get(str(id), {}).get('primaryImageSmall')]
+        if ordered:
+            remote = {str(a.getObjectId()): a for a in self._streamRemote(remoteIds, ordered)}
+            for id in objectIds:
+                if str(id) in remote:
+                    yield remote[str(id)]
+                elif str(id) in records:
+                    yield self._buildArtObject(records[str(id)])
+            return
+        remoteKeys = set(str(id) for id in remoteIds)
+        for id in objectIds:
+            if str(id) not in remoteKeys:
+                yield self._buildArtObject(records[str(id)])
+        yield from self._streamRemote(remoteIds, ordered)
+
+    def _streamRemote(self, objectIds, ordered=False):
+        # fetch the details for objectIds with the selected engine
+        if self._engine == ENGINE_ASYNC:
+            return self._streamAsync(objectIds, ordered)
+        return self._streamThreaded(objectIds, ordered)
+
+    def _streamObjects(self, objectIds, ordered=False):
+        if self._backend == BACKEND_LOCAL:
+            return self._streamLocal(objectIds, ordered)
+        return self._streamRemote(objectIds, ordered)
+
+    def streamArtObjects(self, ordered=False):
+        '''
+        Yield ArtObjects as soon as each lookup finishes, or in search order
+        when ordered is True. The end of the stream is the end of iteration.
+        '''
+        logging.debug('streamArtObjects starting')
+        self.resultSet = ResultSet()
+        self.failedIds = []
+        self._fetchObjectIds()
+        for artObject in self._streamObjects(self.objectSet, ordered):
+            self.resultSet.append(artObject)
+            yield artObject
 
     def fetchArtObjects(self):
         logging.debug('fetArtObjects starting')
-        self.resultSet = []
-        self._fetchObjectIds()
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self._fetchArtObject, id) for id in self.objectSet]
-        for f in futures:
-            self.resultSet.append(f.result())
-        finishedToken = ArtObject(
-            'done',
-            'done',
-            'done',
-            'done',
-            'done',
-            'done',
-            'done'
-        )
-        self.resultSet.append(finishedToken)
+        for artObject in self.streamArtObjects(ordered=True):
+            pass
         return self.resultSet
+
+    def pagedResults(self, pageSize=DEFAULT_PAGE_SIZE, prefetch=True):
+        '''
+        Run the search and return a ResultPages over its object IDs. Object
+        details are only fetched for the pages that are asked for.
+        '''
+        logging.debug('pagedResults starting')
+        self.resultSet = ResultSet()
+        self.failedIds = []
+        self._fetchObjectIds()
+        return ResultPages(self, self.objectSet, pageSize, prefetch)
         
 
     def threadedQuery(self):
@@ -235,37 +1921,156 @@ class Query:
     # This is needed for CI testing
     def runQuery(self):
         resultSet = []
-        queryPayload = {}
-        queryHeaders= {}
-        q = self._museum.getSearchUrlBase()
-        q = q + urlencode(self._parameters)
-        logging.debug(q)
-        response = requests.request("GET", q, headers=queryHeaders, data = queryPayload)
-        jsonResponse = response.json()
-        logging.debug("Rest query reseived " + str(len(jsonResponse)) + " matches")
-        logging.debug(str(jsonResponse))
-        for id in jsonResponse['objectIDs']:
-            objectHeaders = {}
-            objectPayload = {}
-            objectResponse = requests.request(
-                "GET",
-                self._museum.getObjectUrlBase()+str(id),
-                headers=objectHeaders,
-                data=objectPayload
-                )
-            objectJsonResponse = objectResponse.json()
-            resultSet.append(ArtObject(
-                objectJsonResponse['objectID'],
-                objectJsonResponse['title'],
-                objectJsonResponse['artistDisplayName'],
-                objectJsonResponse['objectDate'],
-                objectJsonResponse['artistNationality'],
-                objectJsonResponse['medium'],
-                objectJsonResponse['primaryImageSmall']
-            ))
+        self.failedIds = []
+        self._fetchObjectIds()
+        for id in self.objectSet:
+            try:
+                resultSet.append(self._fetchArtObject(id))
+            except Exception as e:
+                self._skipFailed(id, e)
         return resultSet
 
+class ResultPages:
+    '''
+    Fixed size windows over a search's object IDs. A page's details are
+    fetched the first time it is requested and the following page is
+    prefetched in the background.
+    '''
+    def __init__(self, query, objectIds, pageSize=DEFAULT_PAGE_SIZE, prefetch=True):
+        if pageSize < 1:
+            raise ValueError('pageSize must be at least 1')
+        self._query = query
+        self._objectIds = list(objectIds)
+        self._pageSize = pageSize
+        self._prefetch = prefetch
+        # page number -> Future holding that page's list of ArtObjects
+        self._pages = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._closed = False
+
+    def getTotal(self):
+        return len(self._objectIds)
+
+    def getPageSize(self):
+        return self._pageSize
+
+    def getPageCount(self):
+        return (len(self._objectIds) + self._pageSize - 1) // self._pageSize
+
+    def getPageIds(self, page):
+        start = page * self._pageSize
+        return self._objectIds[start:start + self._pageSize]
+
+    def isLoaded(self, page):
+        with self._lock:
+            future = self._pages.get(page)
+        return future is not None and future.done()
+
+    def _claimPage(self, page):
+        # returns (future, isNew); only the caller that claims a page loads it
+        with self._lock:
+            if page in self._pages:
+                return self._pages[page], False
+            future = Future()
+            self._pages[page] = future
+            return future, True
+
+    def _loadPage(self, page, future):
+        try:
+            artObjects = list(self._query._streamObjects(self.getPageIds(page), ordered=True))
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        future.set_result(artObjects)
+        return artObjects
+
+    def _prefetchPage(self, page):
+        if not self._prefetch or self._closed or page >= self.getPageCount():
+            return
+        future, isNew = self._claimPage(page)
+        if isNew:
+            logging.debug(f'Prefetching result page {page}')
+            self._executor.submit(self._loadPage, page, future)
+
+    def getPage(self, page):
+        '''
+        Return the ArtObjects for a page in search order, blocking until loaded
+        '''
+        if page < 0 or page >= self.getPageCount():
+            return []
+        future, isNew = self._claimPage(page)
+        self._prefetchPage(page + 1)
+        if isNew:
+            return self._loadPage(page, future)
+        return future.result()
+
+    def iterPage(self, page):
+        '''
+        Yield a page's ArtObjects as each lookup completes. Pages that are
+        already loaded (or being prefetched) are served from that load.
+        '''
+        if page < 0 or page >= self.getPageCount():
+            return
+        future, isNew = self._claimPage(page)
+        if not isNew:
+            self._prefetchPage(page + 1)
+            yield from future.result()
+            return
+        pageIds = self.getPageIds(page)
+        artObjects = []
+        try:
+            for artObject in self._query._streamObjects(pageIds):
+                artObjects.append(artObject)
+                yield artObject
+        except GeneratorExit:
+            if self._closed:
+                # nobody wants the rest of this page any more
+                with self._lock:
+                    del self._pages[page]
+                future.cancel()
+                raise
+            # the caller stopped early, finish the page in the background for
+            # anyone else waiting on it
+            self._executor.submit(self._loadPage, page, future)
+            raise
+        except Exception as e:
+            # failed pages are dropped so they can be requested again
+            with self._lock:
+                del self._pages[page]
+            future.set_exception(e)
+            raise
+        # keep the stored page in search order, not completion order
+        position = {str(id): i for i, id in enumerate(pageIds)}
+        artObjects.sort(key=lambda a: position.get(str(a.getObjectId()), len(position)))
+        future.set_result(artObjects)
+        self._prefetchPage(page + 1)
+
+    def getRows(self, start, stop):
+        '''
+        Return the ArtObjects for rows start..stop-1, loading pages as needed
+        '''
+        stop = min(stop, len(self._objectIds))
+        rows = []
+        for page in range(start // self._pageSize, (stop - 1) // self._pageSize + 1):
+            pageStart = page * self._pageSize
+            for offset, artObject in enumerate(self.getPage(page)):
+                if start <= pageStart + offset < stop:
+                    rows.append(artObject)
+        return rows
+
+    def close(self):
+        '''
+        Stop prefetching; pages still streaming can be abandoned
+        '''
+        self._closed = True
+        self._executor.shutdown(wait=False)
+
+
 class ArtObject:
+    # slots instead of a per-instance __dict__, result sets hold a lot of these
+    __slots__ = FAVORITE_FIELDS
+
     def __init__(self, objectId, title, artist, date, nationality, medium, imageUrl):
             self.objectId = objectId
             self.title = title
@@ -296,44 +2101,397 @@ class ArtObject:
     def getImageUrl(self):
         return self.imageUrl
 
+    def toDict(self):
+        '''
+        The fields as a dict, e.g. for JSON export
+        '''
+        return {field: getattr(self, field) for field in FAVORITE_FIELDS}
+
     def save(self, user):
-        db = Database(DB_PATH)
-        db.insertArtObject(user, self)
-        del db
+        Database(DB_PATH).insertArtObject(user, self)
 
     def remove(self, user):
-        db = Database(DB_PATH)
-        db.removeArtObject(user, self)
-        del db
+        Database(DB_PATH).removeArtObject(user, self)
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class ResultSet:
+    '''
+    A list of ArtObjects stored a column per field rather than an object per
+    result. Object IDs are packed into an array while they are all integers
+    and the often repeated text fields are interned. Indexing and iteration
+    hand back ArtObjects.
+    '''
+    # fields with few distinct values across a result set
+    INTERNED = ('artist', 'date', 'nationality', 'medium')
+
+    def __init__(self, artObjects=()):
+        self._objectIds = array('q')
+        self._columns = {field: [] for field in FAVORITE_FIELDS[1:]}
+        self.extend(artObjects)
+
+    def append(self, artObject):
+        try:
+            self._objectIds.append(artObject.objectId)
+        except (TypeError, OverflowError):
+            # not an integer, fall back to a plain list
+            self._objectIds = list(self._objectIds)
+            self._objectIds.append(artObject.objectId)
+        for field, column in self._columns.items():
+            value = getattr(artObject, field)
+            column.append(_intern(value) if field in self.INTERNED else value)
+
+    def extend(self, artObjects):
+        for artObject in artObjects:
+            self.append(artObject)
+
+    def __len__(self):
+        return len(self._objectIds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return ArtObject(self._objectIds[index], *(column[index] for column in self._columns.values()))
+
+    def __iter__(self):
+        for row in zip(self._objectIds, *self._columns.values()):
+            yield ArtObject(*row)
+
+    def getColumn(self, field):
+        '''
+        Every value of one field, in result order
+        '''
+        if field == 'objectId':
+            return list(self._objectIds)
+        return list(self._columns[field])
+
+    def toDicts(self):
+        return [artObject.toDict() for artObject in self]
+
+
+# Favorites rows are written with one prepared statement, as an upsert
+UPSERT_FAVORITE = '''INSERT INTO zeronormal (user, objectId, title, artist, date, nationality, medium, imageUrl) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user, objectId) DO UPDATE SET title=excluded.title, artist=excluded.artist, date=excluded.date, nationality=excluded.nationality, medium=excluded.medium, imageUrl=excluded.imageUrl;'''
+DELETE_FAVORITE = '''DELETE FROM zeronormal WHERE user=? AND objectId=?;'''
+
+# Tables every curator database needs, created once per process by the
+# ConnectionManager that first opens the file
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS zeronormal (user text, objectId text, title text, artist text, date text, nationality text, medium text, imageUrl text, PRIMARY KEY (user, objectId))''',
+    '''CREATE TABLE IF NOT EXISTS objectCache (objectId text PRIMARY KEY, json text, fetchedAt real, etag text, lastModified text)''',
+    '''CREATE TABLE IF NOT EXISTS searchCache (key text PRIMARY KEY, objectIds text, fetchedAt real)''',
+]
+
+class _Reader:
+    # kept in thread-local storage, so it is dropped when its thread ends
+    __slots__ = ('connection', '__weakref__')
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+class ConnectionManager:
+    '''
+    Owns every SQLite connection to one database file for the life of the
+    process: a WAL read connection per live thread and a single writer
+    connection.
+    Queued writes run on a dedicated writer thread, which commits whatever
+    has piled up as one transaction; transaction() lends the writer
+    connection to the calling thread instead.
+    '''
+    _managers = {}
+    _managersLock = threading.Lock()
+
+    @classmethod
+    def forPath(cls, dbPath):
+        with cls._managersLock:
+            manager = cls._managers.get(dbPath)
+            if manager is None:
+                manager = cls(dbPath)
+                cls._managers[dbPath] = manager
+            return manager
+
+    @classmethod
+    def closeAll(cls):
+        with cls._managersLock:
+            managers = list(cls._managers.values())
+            cls._managers.clear()
+        for manager in managers:
+            manager.close()
+
+    def __init__(self, dbPath):
+        self._dbPath = dbPath
+        self._local = threading.local()
+        # finalizers that close each thread's read connection
+        self._readers = []
+        self._readersLock = threading.Lock()
+        self._writeLock = threading.RLock()
+        self._writes = queue.Queue()
+        self._closed = False
+        # the writer is in autocommit mode, transactions are begun explicitly
+        self._writer = self._connect()
+        self._writer.isolation_level = None
+        for statement in SCHEMA:
+            self._writer.execute(statement)
+        self._writerThread = threading.Thread(target=self._writeLoop, name='sqlite-writer', daemon=True)
+        self._writerThread.start()
+        logging.debug(f'Connection manager opened for {dbPath}')
+
+    def _connect(self):
+        # close() runs on whichever thread exits, sqlite3 itself serialises
+        # access to each connection
+        connection = sqlite3.connect(self._dbPath, check_same_thread=False)
+        # WAL lets readers carry on during writes and NORMAL only syncs at
+        # checkpoints, which keeps bulk loads from paying an fsync per commit
+        connection.execute('''PRAGMA journal_mode=WAL''')
+        connection.execute('''PRAGMA synchronous=NORMAL''')
+        return connection
+
+    def getPath(self):
+        return self._dbPath
+
+    def reader(self):
+        '''
+        The calling thread's read connection, opened on first use and closed
+        once the thread has finished
+        '''
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            if self._closed:
+                raise sqlite3.ProgrammingError(f'{self._dbPath} has been closed')
+            reader = _Reader(self._connect())
+            self._local.reader = reader
+            closer = weakref.finalize(reader, reader.connection.close)
+            with self._readersLock:
+                self._readers = [c for c in self._readers if c.alive]
+                self._readers.append(closer)
+        return reader.connection
+
+    def inTransaction(self):
+        return getattr(self._local, 'depth', 0) > 0
+
+    def writer(self):
+        '''
+        The writer connection, only lent out inside transaction()
+        '''
+        if not self.inTransaction():
+            raise sqlite3.ProgrammingError('the writer connection is only available inside transaction()')
+        return self._writer
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Run the enclosed writes on the writer connection as one transaction.
+        Nested transactions join the outermost one.
+        '''
+        with self._writeLock:
+            depth = getattr(self._local, 'depth', 0)
+            if depth == 0:
+                self._writer.execute('''BEGIN''')
+            self._local.depth = depth + 1
+            try:
+                yield self._writer
+            except BaseException:
+                self._local.depth = depth
+                if depth == 0:
+                    self._writer.execute('''ROLLBACK''')
+                raise
+            self._local.depth = depth
+            if depth == 0:
+                self._writer.execute('''COMMIT''')
+
+    def submit(self, work):
+        '''
+        Queue work(connection) for the writer thread, returns a Future
+        '''
+        future = Future()
+        if self._closed:
+            future.set_exception(sqlite3.ProgrammingError(f'{self._dbPath} has been closed'))
+        else:
+            self._writes.put((work, future))
+        return future
+
+    def write(self, work):
+        return self.submit(work).result()
+
+    def _writeLoop(self):
+        while True:
+            jobs = [self._writes.get()]
+            # group commit: everything queued meanwhile shares one transaction
+            while True:
+                try:
+                    jobs.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            done = []
+            started = time.perf_counter()
+            with self._writeLock:
+                self._writer.execute('''BEGIN''')
+                for job in jobs:
+                    if job is None:
+                        continue
+                    work, future = job
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    # a savepoint per job keeps one failure from undoing the rest
+                    self._writer.execute('''SAVEPOINT job''')
+                    try:
+                        result = work(self._writer)
+                    except Exception as e:
+                        self._writer.execute('''ROLLBACK TO job''')
+                        self._writer.execute('''RELEASE job''')
+                        done.append((future, None, e))
+                    else:
+                        self._writer.execute('''RELEASE job''')
+                        done.append((future, result, None))
+                self._writer.execute('''COMMIT''')
+            METRICS.observe('db.commit.seconds', time.perf_counter() - started)
+            METRICS.observe('db.commit.batchSize', len(jobs), SIZE_BUCKETS)
+            # callers only hear back once their write is committed
+            for future, result, error in done:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+            if None in jobs:
+                return
+
+    def close(self):
+        '''
+        Finish queued writes, then close the writer and every read connection
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        self._writes.put(None)
+        self._writerThread.join()
+        with self._writeLock:
+            self._writer.close()
+        with self._readersLock:
+            for closer in self._readers:
+                closer()
+            self._readers = []
+        logging.debug(f'Connection manager closed for {self._dbPath}')
+
+atexit.register(ConnectionManager.closeAll)
+
 
 class Database:
+    '''
+    Curator's queries, run over the shared connections of the
+    ConnectionManager for dbPath. Cheap to create and safe to share between
+    threads: reads use the calling thread's read connection and writes go to
+    the single writer.
+    '''
     def __init__(self, dbPath):
         self.dbPath = dbPath
-        self.dbConnect = sqlite3.connect(self.dbPath)
-        self.dbCursor = self.dbConnect.cursor()
-        self.dbCursor.execute('''CREATE TABLE IF NOT EXISTS zeronormal (user text, objectId text, title text, artist text, date text, nationality text, medium text, imageUrl text, PRIMARY KEY (user, objectId))''')
-        self.dbConnect.commit()
+        self._manager = ConnectionManager.forPath(dbPath)
         logging.debug("Database object created successfully")
 
-    def insertArtObject(self, user, artObject):
+    @contextmanager
+    def transaction(self):
+        '''
+        Run the enclosed writes as one transaction with a single commit.
+        Nested transactions join the outermost one.
+        '''
+        with self._manager.transaction():
+            yield self
+
+    def execute(self, sql, parameters=()):
+        '''
+        Run a write and return the number of rows it changed
+        '''
+        with METRICS.timer('db.write.seconds'):
+            if self._manager.inTransaction():
+                return self._manager.writer().execute(sql, parameters).rowcount
+            return self._manager.write(lambda connection: connection.execute(sql, parameters).rowcount)
+
+    def executeMany(self, sql, rows):
+        rows = list(rows)
+        METRICS.increment('db.rowsWritten', len(rows))
+        with METRICS.timer('db.write.seconds'):
+            if self._manager.inTransaction():
+                return self._manager.writer().executemany(sql, rows).rowcount
+            return self._manager.write(lambda connection: connection.executemany(sql, rows).rowcount)
+
+    def query(self, sql, parameters=()):
+        '''
+        Run a read and return its rows. Inside a transaction this reads from
+        the writer so the transaction's own changes are visible.
+        '''
+        with METRICS.timer('db.read.seconds'):
+            if self._manager.inTransaction():
+                return self._manager.writer().execute(sql, parameters).fetchall()
+            return self._manager.reader().execute(sql, parameters).fetchall()
+
+    def upsertArtObjects(self, user, artObjects):
         logging.debug("Peristing favorites")
-        self.dbCursor.execute('''INSERT OR REPLACE INTO zeronormal (user, objectId, title, artist, date, nationality, medium, imageUrl) VALUES (?, ?, ?, ?, ?, ?, ?, ?);''', (user.getName(), str(artObject.getObjectId()), artObject.getTitle(), artObject.getArtist(), artObject.getDate(), artObject.getNationality(), artObject.getMedium(), artObject.getImageUrl(),))
-        self.dbConnect.commit()
+        self.executeMany(UPSERT_FAVORITE, [
+            (user.getName(), str(artObject.getObjectId()), artObject.getTitle(), artObject.getArtist(), artObject.getDate(), artObject.getNationality(), artObject.getMedium(), artObject.getImageUrl())
+            for artObject in artObjects
+        ])
 
-    def removeArtObject(self, user, artObject):
+    def removeArtObjects(self, user, artObjects):
         logging.debug("Removing from favorites table")
-        self.dbCursor.execute('''DELETE FROM zeronormal WHERE user=? AND objectId=?;''', (user.getName(), str(artObject.getObjectId())))
-        self.dbConnect.commit()
+        self.executeMany(DELETE_FAVORITE, [(user.getName(), str(artObject.getObjectId())) for artObject in artObjects])
+
+    def insertArtObject(self, user, artObject):
+        self.upsertArtObjects(user, [artObject])
+
+    def removeArtObject(self, user, artObject):
+        self.removeArtObjects(user, [artObject])
 
     def getFavorites(self, user):
         logging.debug("Checking for persisted favorites")
         resultSet = []
-        self.dbCursor.execute("SELECT objectId, title, artist, date, nationality, medium, imageUrl from zeronormal where user=? ORDER BY title ASC;", (user.getName(),))
-        rows = self.dbCursor.fetchall()
+        rows = self.query("SELECT objectId, title, artist, date, nationality, medium, imageUrl from zeronormal where user=? ORDER BY title ASC;", (user.getName(),))
         for row in rows:
             resultSet.append(ArtObject(row[0], row[1], row[2], row[3], row[4], row[5], row[6]))
         return resultSet
 
-    def __del__(self):
-        self.dbConnect.close
-        logging.debug("Releasing Database resource")
+    def getCachedObject(self, objectId):
+        rows = self.query('''SELECT json, fetchedAt, etag, lastModified FROM objectCache WHERE objectId=?;''', (str(objectId),))
+        return rows[0] if rows else None
+
+    def putCachedObject(self, objectId, jsonText, fetchedAt, etag, lastModified):
+        self.execute('''INSERT OR REPLACE INTO objectCache (objectId, json, fetchedAt, etag, lastModified) VALUES (?, ?, ?, ?, ?);''', (str(objectId), jsonText, fetchedAt, etag, lastModified))
+
+    def touchCachedObject(self, objectId, fetchedAt):
+        self.execute('''UPDATE objectCache SET fetchedAt=? WHERE objectId=?;''', (fetchedAt, str(objectId)))
+
+    def getCachedSearch(self, key):
+        rows = self.query('''SELECT objectIds, fetchedAt FROM searchCache WHERE key=?;''', (key,))
+        return rows[0] if rows else None
+
+    def putCachedSearch(self, key, objectIds, fetchedAt):
+        self.execute('''INSERT OR REPLACE INTO searchCache (key, objectIds, fetchedAt) VALUES (?, ?, ?);''', (key, objectIds, fetchedAt))
+
+    def mirrorExists(self):
+        return self.query('''SELECT count(name) FROM sqlite_master WHERE type='table' AND name='mirrorObjects';''')[0][0] == 1
+
+    def searchMirror(self, where, values):
+        query = 'SELECT objectId FROM mirrorObjects'
+        if where:
+            query += ' WHERE ' + where
+        return [row[0] for row in self.query(query + ' ORDER BY objectId;', values)]
+
+    def getMirrorObjects(self, objectIds):
+        rows = []
+        objectIds = [int(id) for id in objectIds]
+        # stay well below SQLite's limit on bound parameters
+        for start in range(0, len(objectIds), 500):
+            chunk = objectIds[start:start + 500]
+            rows.extend(self.query('SELECT objectId, title, artist, objectDate, nationality, medium FROM mirrorObjects WHERE objectId IN (' + ', '.join('?' for id in chunk) + ');', chunk))
+        return rows
+
+    def close(self):
+        '''
+        Close this file's connections now rather than at exit
+        '''
+        self._manager.close()
+        with ConnectionManager._managersLock:
+            if ConnectionManager._managers.get(self.dbPath) is self._manager:
+                del ConnectionManager._managers[self.dbPath]
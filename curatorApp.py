@@ -1,35 +1,72 @@
 import logging  # used for logging
-import json     # used for encoding/decoding favorites
 # Image processing
-from urllib.request import urlopen  # used in retrieving image
-import io  # used to handle byte stream for image
-from PIL import Image, ImageTk  # used to handle images
+from PIL import ImageTk  # used to handle images
 # GUI
-from tkinter import Tk, Menu, BOTH, HORIZONTAL, X, IntVar, StringVar, END, filedialog, messagebox
+from tkinter import Tk, Menu, BOTH, HORIZONTAL, X, IntVar, StringVar, END, TclError, filedialog, messagebox
 from tkinter.ttk import Button, Checkbutton, Entry, Label, Panedwindow, Progressbar, Spinbox, Treeview, Style
 # Curator API
-from curator import Museum, Query, User, ArtObject
+from curator import Museum, Query, User, ArtObject, ImageCache, ImagePrefetcher, METRICS, END_OF_RESULTS, DEFAULT_PAGE_SIZE, DEFAULT_PREFETCH_ROWS
 
 import threading
 from concurrent.futures import ThreadPoolExecutor
 import queue
+import time # used to report startup timings
+import os # CURATOR_METRICS selects where metrics are reported
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 
+LOGO_URL = 'https://www.csuchico.edu/style-guide/visual/_images/Chico-state-athletics-icon.png'
+# Result rows whose images are prefetched as a new search streams in
+FIRST_SCREEN_ROWS = 30
+# Seconds per Tk callback spent moving results into the tree, so the window
+# keeps redrawing while thousands of rows arrive
+DEFAULT_FRAME_BUDGET = 0.012
+# Milliseconds between checks for results while the queue is empty
+PUMP_INTERVAL_MS = 16
+
 
 class CuratorApp:
     ''' GUI for Metropolitan Museum Open Access API '''
-    def __init__(self, root):
+    def __init__(self, root, startedAt=None, frameBudget=DEFAULT_FRAME_BUDGET):
+        # startup timings are reported relative to this
+        self.startedAt = time.perf_counter() if startedAt is None else startedAt
         self.museum = Museum(
             "Metropolitan Museum",
             "https://collectionapi.metmuseum.org/public/collection/v1/search?",
             "https://collectionapi.metmuseum.org/public/collection/v1/objects/"
         )
         self.queryObject = Query(self.museum)
-        self.user = User('curator')
+        # favorites are loaded in the background once the window is up
+        self.user = User('curator', load=False)
+        self.imageCache = ImageCache(self.museum.getSession())
         
+        self.root = root
         self.executor = ThreadPoolExecutor()
         self.artObjectQueue = queue.Queue()
+
+        # Images are downloaded, decoded and resized off the Tk thread; only
+        # the newest request is shown
+        self.imageExecutor = ThreadPoolExecutor(max_workers=2)
+        self.imageRequest = 0
+        self.imageFuture = None
+
+        # Images for nearby rows are fetched ahead of the user's next click
+        self.prefetcher = ImagePrefetcher(self.imageCache)
+        self.prefetchRows = DEFAULT_PREFETCH_ROWS
+        self.prefetchSize = None
+        self.rowsShown = 0
+
+        # Search results are fetched one page at a time as the tree scrolls
+        self.pageSize = DEFAULT_PAGE_SIZE
+        self.resultPages = None
+        self.nextPage = 0
+        self.loadingPage = False
+        # results reach the tree through a time-sliced pump on the Tk thread;
+        # pumps and streams of an earlier search stop once this moves on
+        self.frameBudget = frameBudget
+        self.searchGeneration = 0
+        self.pageStarted = 0
+        self.pageRows = 0
         
         # Menu
         menubar = Menu(root)
@@ -86,19 +123,19 @@ class CuratorApp:
         )
         self.isTitleSearchValue.set(1)
         self.dept = Label(self.controlFrame, text='Department')
-        departmentsList = self.museum.getDepartmentList()
+        # the department and classification lists are filled in by
+        # _startBackgroundLoad()
         self.departmentSelector = Spinbox(
             self.controlFrame,
-            values=departmentsList,
+            values=[],
             textvariable=self.department,
             wrap=False
         )
         self.departmentSelector.set("European Paintings")
         self.classification = Label(self.controlFrame, text='Classification')
-        classificatinList = self.museum.getClassifications()
         self.classificationSelector = Spinbox(
             self.controlFrame,
-            values=classificatinList,
+            values=[],
             textvariable=self.classificationValue,
             wrap=False
         )
@@ -162,6 +199,7 @@ class CuratorApp:
         self.resultsTree.config(selectmode='browse', show='tree', columns=('ID', 'Artist', 'Date', 'Nationality', 'Medium', 'Favorite'), displaycolumns=['Favorite'])
         self.resultsTree.column('Favorite', anchor='center', width=30, stretch=False)
         self.resultsTree.bind('<ButtonRelease-1>', self._selectionHandler)
+        self.resultsTree.config(yscrollcommand=self._onResultsScroll)
         # Widgets for imageFrame
         self.artObjectImage = Label(
             self.imageFrame,
@@ -173,7 +211,8 @@ class CuratorApp:
             text=''
         )
 
-        # Updates image to WildCat Logo before controls are displayed
+        # Updates image to WildCat Logo before controls are displayed, from
+        # the on-disk image cache after the first run
         self.displayLogo()
 
         # Place controls
@@ -207,9 +246,59 @@ class CuratorApp:
         style = Style()
         style.configure("Treeview", rowheight=25)
 
-        # Display favorites on startup (if set)
-        self.user.loadFavorites()
-        self.listFavorites()
+        # Slow startup data arrives after the window is shown
+        self._startBackgroundLoad()
+
+    def _sinceStart(self):
+        return time.perf_counter() - self.startedAt
+
+    def _startBackgroundLoad(self):
+        '''
+        Load departments, classifications and favorites off the Tk thread,
+        filling in each widget as its data arrives
+        '''
+        self.root.bind('<Map>', self._firstPaint)
+        stages = {
+            'departments': (self.museum.getDepartmentList, self._setDepartments),
+            'classifications': (self.museum.getClassifications, self._setClassifications),
+            # Display favorites on startup (if set)
+            'favorites': (self.user.loadFavorites, lambda result: self.listFavorites()),
+        }
+        self.startupPending = set(stages)
+        self.progressbar.start()
+        for name, (load, apply) in stages.items():
+            future = self.executor.submit(load)
+            future.add_done_callback(
+                lambda future, name=name, apply=apply: self.root.after(0, self._startupStageDone, name, future, apply)
+            )
+
+    def _startupStageDone(self, name, future, apply):
+        try:
+            apply(future.result())
+            logging.debug(f'Startup: {name} loaded at {self._sinceStart():.3f}s')
+        except Exception as e:
+            logging.info(f'Startup: loading {name} failed. {str(e)}')
+        self.startupPending.discard(name)
+        if not self.startupPending:
+            self.progressbar.stop()
+            METRICS.setGauge('ui.startup.interactiveSeconds', self._sinceStart())
+            logging.info(f'Time to interactive: {self._sinceStart():.3f}s')
+
+    def _firstPaint(self, event):
+        if event.widget is self.root:
+            self.root.unbind('<Map>')
+            METRICS.setGauge('ui.startup.firstPaintSeconds', self._sinceStart())
+            logging.info(f'Time to first paint: {self._sinceStart():.3f}s')
+
+    def _setDepartments(self, departments):
+        current = self.departmentSelector.get()
+        self.departmentSelector.config(values=departments)
+        self.departmentSelector.set(current)
+
+    def _setClassifications(self, classifications):
+        current = self.classificationSelector.get()
+        self.classificationSelector.config(values=classifications)
+        self.classificationSelector.set(current)
 
 
 
@@ -251,60 +340,170 @@ class CuratorApp:
         '''
         displayLogo(): load logo into artObjectImage control
         '''
-        self.openedUrl = urlopen('https://www.csuchico.edu/style-guide/visual/_images/Chico-state-athletics-icon.png')
-        self.objectImage = io.BytesIO(self.openedUrl.read())
-        self.pilImage = Image.open(self.objectImage)
+        self._requestImage(LOGO_URL, None, self._setLogo)
+
+    def _setLogo(self, pilImage):
+        self.pilImage = pilImage
         self.tkImage = ImageTk.PhotoImage(self.pilImage)
         self.artObjectImage.config(image=self.tkImage)
 
-        # self.updateImage('https://www.csuchico.edu/style-guide/visual/_images/Chico-state-athletics-icon.png')
-        
-    def queueArtObjects(self):
+    def _requestImage(self, url, size, show):
         '''
-        queueArtObjects(): loads images in queue objects result set into a queue
+        Load an image on the image worker and pass it to show() on the Tk
+        thread, unless a newer image has been requested in the meantime
+        '''
+        self.imageRequest += 1
+        requestId = self.imageRequest
+        if self.imageFuture is not None:
+            self.imageFuture.cancel()
+        self.imageFuture = self.imageExecutor.submit(self.imageCache.getImage, url, size)
+        self.imageFuture.add_done_callback(
+            lambda future: self.root.after(0, self._imageReady, requestId, future, show)
+        )
+
+    def _imageReady(self, requestId, future, show):
+        if requestId != self.imageRequest or future.cancelled():
+            logging.debug(f'Dropping stale image request {requestId}')
+            return
+        try:
+            pilImage = future.result()
+        except Exception as e:
+            logging.debug(f'Couldn\'t load image. {str(e)}')
+            return
+        show(pilImage)
+
+    def queueArtObjects(self, page, results, generation, pages=None):
+        '''
+        queueArtObjects(): streams a page of art objects into results as each
+        lookup completes, until a newer search starts. Without pages this
+        runs the search first.
         '''
         logging.debug('queueArtObjects thread running')
-        resultSet = self.queryObject.fetchArtObjects()
-        for artObject in resultSet:
-            logging.debug('queueArtObjects adding objects to queue')
-            self.artObjectQueue.put(artObject)
+        try:
+            if pages is None:
+                pages = self.queryObject.pagedResults(self.pageSize)
+                self.root.after(0, self._setResultPages, generation, pages)
+            for artObject in pages.iterPage(page):
+                if generation != self.searchGeneration:
+                    # a newer search has started, stop fetching this one
+                    break
+                results.put(artObject)
+                METRICS.setGauge('ui.queue.depth', results.qsize())
+        except Exception as e:
+            logging.info(f'Loading result page {page} failed. {str(e)}')
+            # the pump reports it on the Tk thread
+            results.put(e)
+        finally:
+            # always signal the end of the stream so the pump stops
+            results.put(END_OF_RESULTS)
         logging.debug('queueArtObjects finished queueing Art Objects')
-    
-    def dequeueArtObjects(self):
+
+    def _setResultPages(self, generation, pages):
+        if generation != self.searchGeneration:
+            pages.close()
+            return
+        self.resultPages = pages
+
+    def dequeueArtObjects(self, page, results, generation):
         '''
-        dequeueArtObjects: loads queued objects into TreeView contoller
+        dequeueArtObjects: UI pump, runs on the Tk thread via root.after and
+        moves queued objects into the TreeView until the frame budget is
+        spent, then yields to Tk and picks up where it left off
         '''
-        logging.debug('dequeueArtObjects thread running')
+        if generation != self.searchGeneration:
+            # superseded by a newer search, its rows are no longer wanted
+            return
+        sliceStarted = time.perf_counter()
+        deadline = sliceStarted + self.frameBudget
+        rows = 0
+        finished = False
+        budgetExhausted = False
         while True:
-            artObject = self.artObjectQueue.get()
-            logging.debug('dequeueArtObjects: ' + artObject.title)
-            if artObject.title == 'done':
-                logging.debug('dequeueArtjects done')
+            try:
+                artObject = results.get_nowait()
+            except queue.Empty:
                 break
-            else:
-                logging.debug('dequeueArtObjects: inserting ' + artObject.title)
-                self.executor.submit(self.resultsTree.insert(
+            if artObject is END_OF_RESULTS:
+                finished = True
+                break
+            if isinstance(artObject, Exception):
+                messagebox.showerror("Search Failed", f"Couldn't load the search results. {str(artObject)}")
+                continue
+            try:
+                self.resultsTree.insert(
                     'searchResults',
                     END,
                     artObject.imageUrl,
                     text=artObject.title,
                     values=[
                         artObject.objectId,
-                        artObject.artist, 
-                        artObject.date, 
-                        artObject.nationality, 
-                        artObject.medium, 
+                        artObject.artist,
+                        artObject.date,
+                        artObject.nationality,
+                        artObject.medium,
                         self._getFavoriteIcon(self.user.isFavorite(artObject.objectId))
                     ]
-                ))
-        self.executor.submit(self.displayLogo)
+                )
+            except TclError as e:
+                # e.g. two results sharing an image URL, skip the row rather
+                # than stop the pump
+                logging.debug(f'Couldn\'t add {artObject.objectId} to the results. {str(e)}')
+                continue
+            if self.rowsShown < FIRST_SCREEN_ROWS:
+                self.prefetcher.prefetch([artObject.imageUrl], self.prefetchSize)
+            self.rowsShown += 1
+            rows += 1
+            if time.perf_counter() >= deadline:
+                budgetExhausted = True
+                break
+        self.pageRows += rows
+        METRICS.increment('ui.rows.inserted', rows)
+        METRICS.observe('ui.pump.seconds', time.perf_counter() - sliceStarted)
+        METRICS.setGauge('ui.queue.depth', results.qsize())
+        if not finished:
+            # straight back if the budget ran out, otherwise wait for more results
+            self.root.after(1 if budgetExhausted else PUMP_INTERVAL_MS, self.dequeueArtObjects, page, results, generation)
+            return
+        logging.debug(f'dequeueArtObjects: page {page} done, {self.pageRows} rows')
+        elapsed = time.perf_counter() - self.pageStarted
+        METRICS.observe('ui.page.seconds', elapsed)
+        if elapsed > 0:
+            METRICS.setGauge('ui.rows.perSecond', self.pageRows / elapsed)
+        if page == 0 and not self.resultsTree.selection():
+            # a row picked while the page streamed in keeps its image
+            self.displayLogo()
+        self.nextPage = page + 1
+        self.loadingPage = False
         self.progressbar.stop()
+
+    def _loadPage(self, page):
+        '''
+        Fetch a page of search results in the background and add it to the tree
+        '''
+        logging.debug(f'Loading result page {page}')
+        self.loadingPage = True
+        self.progressbar.start()
+        self.pageStarted = time.perf_counter()
+        self.pageRows = 0
+        # each page streams through its own queue, tagged with its search
+        self.artObjectQueue = queue.Queue()
+        pages = None if page == 0 else self.resultPages
+        self.executor.submit(self.queueArtObjects, page, self.artObjectQueue, self.searchGeneration, pages)
+        self.root.after(0, self.dequeueArtObjects, page, self.artObjectQueue, self.searchGeneration)
+
+    def _onResultsScroll(self, first, last):
+        '''
+        yscrollcommand for resultsTree: loads the next page near the bottom
+        '''
+        if self.loadingPage or self.resultPages is None or float(last) < 0.9:
+            return
+        if self.nextPage < self.resultPages.getPageCount():
+            self._loadPage(self.nextPage)
     
     def runSearch(self):
         '''
         Runs the rest query based on the paramters selected in GUI
         '''
-        self.progressbar.start()
         # reset adapated from:
         # https://stackoverflow.com/questions/22812134/how-to-clear-an-entire-treeview-with-tkinter
         for i in self.resultsTree.get_children():
@@ -315,9 +514,19 @@ class CuratorApp:
         self.resultsTree.item("searchResults", open = True)
 
         self.buildQuery()
-        
-        self.executor.submit(self.queueArtObjects)
-        self.executor.submit(self.dequeueArtObjects)  
+
+        # Prefetches for the previous search are no longer useful
+        self.prefetcher.cancel()
+        self.prefetchSize = self._imageSize()
+        self.rowsShown = 0
+
+        # drop whatever the previous search is still streaming
+        self.searchGeneration += 1
+        if self.resultPages is not None:
+            self.resultPages.close()
+            self.resultPages = None
+        self.nextPage = 0
+        self._loadPage(0)
     
     def detailsCheck(self, artist, date, nationality, medium): 
         if artist:
@@ -452,15 +661,35 @@ class CuratorApp:
         medium_val = ''.join(self.resultsTree.item(i, "value")[4])
         self.updateDescription(artist_value, date_value, nationality_val, medium_val)
         self.updateImage(i.replace('_cur_fav_', ''))
+        self._prefetchNeighbours(i)
+
+    def _imageSize(self):
+        '''
+        Size images are reduced to so they fit the image pane
+        '''
+        return (self.imageFrame.winfo_width()-15, self.imageFrame.winfo_width())
+
+    def _prefetchNeighbours(self, i):
+        '''
+        Prefetch images for the rows just above and below the selected one
+        '''
+        siblings = self.resultsTree.get_children(self.resultsTree.parent(i))
+        position = siblings.index(i)
+        start = max(position - self.prefetchRows, 0)
+        neighbours = siblings[start:position] + siblings[position + 1:position + 1 + self.prefetchRows]
+        self.prefetcher.prefetch(
+            [n.replace('_cur_fav_', '') for n in neighbours],
+            self._imageSize()
+        )
 
     def updateImage(self, url):
         '''
-        Sets the art image in the image pane
+        Sets the art image in the image pane once it has loaded
         '''
-        self.openedUrl = urlopen(url)
-        self.objectImage = io.BytesIO(self.openedUrl.read())
-        self.pilImage = Image.open(self.objectImage)
-        self.pilImage.thumbnail((self.imageFrame.winfo_width()-15, self.imageFrame.winfo_width()))
+        self._requestImage(url, self._imageSize(), self._setImage)
+
+    def _setImage(self, pilImage):
+        self.pilImage = pilImage
         self.tkImage = ImageTk.PhotoImage(self.pilImage)
         self.artObjectImage.destroy()
         self.artObjectImage = Label(
@@ -601,32 +830,20 @@ class CuratorApp:
                     defaultextension='.curator'
                 )
 
-                favorites = json.load(file)
-                for f in favorites:
-                    self.user.addFavorite(ArtObject(
-                    f['objectId'],
-                    f['title'], 
-                    f['artist'], 
-                    f['date'],
-                    f['nationality'],
-                    f['medium'],
-                    f['imageUrl']
-                    )
-                )
-
+                for artObject in self.user.importFavorites(file):
                     # Change the favorites icon if item is visible in search results
-                    if self.resultsTree.exists(f['imageUrl']):
-                        self.resultsTree.item(f['imageUrl'], values = [
-                            f['objectId'],
-                            f['artist'],
-                            f['date'],
-                            f['nationality'],
-                            f['medium'],
+                    if self.resultsTree.exists(artObject.imageUrl):
+                        self.resultsTree.item(artObject.imageUrl, values = [
+                            artObject.objectId,
+                            artObject.artist,
+                            artObject.date,
+                            artObject.nationality,
+                            artObject.medium,
                             self._getFavoriteIcon(True)
                         ])
 
                 file.close()
-            except TypeError as e:
+            except (TypeError, ValueError, KeyError) as e:
                 logging.debug(f'Couldn\'t convert JSON favorites to obj. {str(e)}')
             except Exception as e:
                 logging.debug(f'Something went wrong importing favorites. {str(e)}')
@@ -649,14 +866,7 @@ class CuratorApp:
                 filetypes=[('Curator Favorites', '*.curator')], 
                 defaultextension='.curator'
             )
-            favorites = self.user.getFavorites()
-            json.dump(
-                favorites, 
-                file, 
-                default=lambda o: o.__dict__, 
-                sort_keys=True, 
-                indent=4
-            )
+            self.user.exportFavorites(file)
             file.close()
         except TypeError as e:
             logging.debug(f'Couldn\'t convert favorites to JSON. {str(e)}')
@@ -667,11 +877,18 @@ class CuratorApp:
                 file.close()
 
 def main():
+    startedAt = time.perf_counter()
+    # e.g. CURATOR_METRICS=prometheus:9464 or CURATOR_METRICS=jsonl:metrics.jsonl
+    METRICS.configure(os.environ.get('CURATOR_METRICS'))
     root = Tk()
     root.title("Curator")
     root.geometry("1100x700+10+10")
-    app = CuratorApp(root)
+    app = CuratorApp(root, startedAt)
     root.mainloop()
+    # favorites are written behind, make sure the last changes reach the db
+    app.user.flush()
+    app.museum.close()
+    METRICS.disable()
     del app
     del root
 
@@ -0,0 +1,557 @@
+# Purpose: offline benchmarks for the curator library, run against a local
+# stand-in for the Met collection API
+#
+# Usage: python3 curator_bench.py [--runs 5] [--objects 100] [--latency 0.01]
+#        [--output curator_bench.json] [--baseline previous.json]
+
+import argparse # used for the command line
+import contextlib # used to silence parse_to_sql's progress output
+import csv # used to write the synthetic collection CSV
+import hashlib # used for the mock API's ETags
+import io # used to build the stand-in image
+import json # used for API responses and the results file
+import logging # used for logging
+import math # used for percentiles
+import os # used for scratch files
+import platform # recorded with the results
+import random # used to inject latency, errors and throttling
+import shutil # used to clean up scratch files
+import sys # used for the exit status
+import tempfile # used for scratch databases and files
+import threading # used to run the server and guard its counters
+import time # used for timings
+import tracemalloc # used to measure peak memory
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import curator
+
+DEFAULT_RESULTS = 'curator_bench.json'
+# Fraction by which a benchmark's p50 may grow over the baseline before it
+# counts as a regression
+DEFAULT_TOLERANCE = 0.25
+# Benchmarks, in the order they run: name -> prepare(options, server, scratch)
+BENCHMARKS = {}
+
+
+class MockMetHandler(BaseHTTPRequestHandler):
+    ''' Answers /search, /objects/{id} and /images/{id}.jpg like the Met API '''
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, don't let Nagle hold them
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        server.connected(self.client_address)
+        time.sleep(server.nextLatency())
+        status = server.nextScripted(self.path)
+        if status is not None:
+            self._send(status, b'', 'text/plain', {'Retry-After': '0'})
+            return
+        if not server.admit():
+            # the Met answers clients over its rate limit with a 429
+            self._send(429, b'', 'text/plain', {'Retry-After': '1'})
+            return
+        if server.injectError():
+            self._send(500, b'', 'text/plain')
+            return
+        path = urlsplit(self.path).path
+        if path.startswith('/search'):
+            body = {'total': server.objects, 'objectIDs': list(range(1, server.objects + 1))}
+            self._sendJson(body)
+        elif path.startswith('/objects/'):
+            objectId = int(path.rsplit('/', 1)[-1])
+            if objectId in server.missing:
+                self._send(404, b'{"message": "Not a valid object"}', 'application/json')
+                return
+            self._sendJson({
+                'objectID': objectId,
+                'title': f'Object {objectId}',
+                'artistDisplayName': 'Artist',
+                'objectDate': '1900',
+                'artistNationality': 'French',
+                'medium': 'Oil on canvas',
+                'primaryImageSmall': f'{server.url}/images/{objectId}.jpg'
+            })
+        elif path.startswith('/images/'):
+            self._send(200, server.imageBytes(), 'image/jpeg')
+        else:
+            self._send(404, b'', 'text/plain')
+
+    def _sendJson(self, body):
+        payload = json.dumps(body).encode('utf-8')
+        etag = f'"{hashlib.md5(payload).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, b'', 'application/json', {'ETag': etag})
+            return
+        self._send(200, payload, 'application/json', {'ETag': etag})
+
+    def _send(self, status, payload, contentType, headers={}):
+        self.server.count(status)
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockMetServer(ThreadingHTTPServer):
+    '''
+    Local stand-in for the Met collection API, shared by the benchmarks and
+    the tests. It can add latency (with jitter), fail a fraction of requests
+    with a 500, throttle clients above throttleRate requests per second with
+    a 429 and answer a path with scripted statuses before serving it.
+    '''
+    daemon_threads = True
+    # the async engine opens dozens of connections at once, the default
+    # backlog of 5 drops them into a one second SYN retry
+    request_queue_size = 128
+
+    def __init__(self, objects=100, latency=0.0, jitter=0.0, errorRate=0.0, throttleRate=None, seed=0, missing=(), imageSize=(640, 480)):
+        super().__init__(('127.0.0.1', 0), MockMetHandler)
+        self.objects = objects
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.latency = latency
+        self.jitter = jitter
+        # object IDs answered with a 404
+        self.missing = set(missing)
+        # path -> statuses to answer with before serving it normally
+        self.scripted = {}
+        # client (host, port) of every connection that made a request
+        self.connections = set()
+        self._errorRate = errorRate
+        self._throttleRate = throttleRate
+        self._imageSize = imageSize
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = throttleRate or 0
+        self._updated = time.monotonic()
+        self._image = None
+        self._statuses = {}
+        self._thread = None
+
+    def getConfig(self):
+        return {
+            'objects': self.objects,
+            'latency': self.latency,
+            'jitter': self.jitter,
+            'errorRate': self._errorRate,
+            'throttleRate': self._throttleRate,
+        }
+
+    def getStatuses(self):
+        with self._lock:
+            return dict(self._statuses)
+
+    def count(self, status):
+        with self._lock:
+            self._statuses[str(status)] = self._statuses.get(str(status), 0) + 1
+
+    def connected(self, address):
+        with self._lock:
+            self.connections.add(address)
+
+    def nextScripted(self, path):
+        with self._lock:
+            script = self.scripted.get(path)
+            return script.pop(0) if script else None
+
+    def nextLatency(self):
+        with self._lock:
+            return max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0.0)
+
+    def injectError(self):
+        with self._lock:
+            return self._random.random() < self._errorRate
+
+    def admit(self):
+        # server side token bucket, one second of burst
+        if not self._throttleRate:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._throttleRate, self._tokens + (now - self._updated) * self._throttleRate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def imageBytes(self):
+        with self._lock:
+            if self._image is None:
+                from PIL import Image # only needed once images are requested
+                buffer = io.BytesIO()
+                Image.new('RGB', self._imageSize, 'gray').save(buffer, 'JPEG')
+                self._image = buffer.getvalue()
+            return self._image
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def benchmark(name):
+    '''
+    Register prepare(options, server, scratch) as a benchmark. prepare does
+    the untimed setup and returns (run, cleanup); run(samples) does the timed
+    work and returns the number of items it handled. Where items are timed
+    one by one (a request, an image, a favorite) run appends each latency in
+    seconds to samples; bulk operations leave samples empty.
+    '''
+    def register(prepare):
+        BENCHMARKS[name] = prepare
+        return prepare
+    return register
+
+
+def _museum(server, scratch):
+    # a fresh database per run, so every run starts with cold caches
+    curator.DB_PATH = os.path.join(scratch, f'bench-{time.monotonic_ns()}.db')
+    return curator.Museum(
+        name = "Mock Museum",
+        searchUrlBase = f'{server.url}/search?',
+        objectUrlBase = f'{server.url}/objects/'
+    )
+
+
+def _timeRequests(museum, samples, engine=curator.ENGINE_THREADED):
+    # latency of every request as the client sees it, retries and rate
+    # limiting included
+    session = museum.getSession()
+    get = session.get
+    def timedGet(url, headers=None):
+        started = time.perf_counter()
+        try:
+            return get(url, headers=headers)
+        finally:
+            samples.append(time.perf_counter() - started)
+    session.get = timedGet
+    if engine != curator.ENGINE_ASYNC:
+        return
+    fetcher = museum.getAsyncFetcher()
+    fetch = fetcher._fetch
+    async def timedFetch(*args):
+        started = time.perf_counter()
+        try:
+            return await fetch(*args)
+        finally:
+            samples.append(time.perf_counter() - started)
+    fetcher._fetch = timedFetch
+
+
+def _query(museum, engine=curator.ENGINE_THREADED):
+    query = curator.Query(museum, engine=engine)
+    query.setParameter('q', 'benchmark')
+    return query
+
+
+@benchmark('runQuery')
+def prepareRunQuery(options, server, scratch):
+    museum = _museum(server, scratch)
+    query = _query(museum)
+    def run(samples):
+        _timeRequests(museum, samples)
+        return len(query.runQuery())
+    return run, museum.close
+
+
+def _prepareFetch(engine):
+    def prepare(options, server, scratch):
+        museum = _museum(server, scratch)
+        query = _query(museum, engine)
+        def run(samples):
+            _timeRequests(museum, samples, engine)
+            return len(query.fetchArtObjects())
+        return run, museum.close
+    return prepare
+
+benchmark('fetchArtObjects[threaded]')(_prepareFetch(curator.ENGINE_THREADED))
+benchmark('fetchArtObjects[async]')(_prepareFetch(curator.ENGINE_ASYNC))
+
+
+@benchmark('imageCache')
+def prepareImageCache(options, server, scratch):
+    museum = _museum(server, scratch)
+    cache = curator.ImageCache(museum.getSession(), cacheDir=tempfile.mkdtemp(dir=scratch))
+    urls = [f'{server.url}/images/{id}.jpg' for id in range(1, server.objects + 1)]
+    def run(samples):
+        for url in urls:
+            started = time.perf_counter()
+            cache.getImage(url, (300, 300))
+            samples.append(time.perf_counter() - started)
+        return len(urls)
+    return run, museum.close
+
+
+def _favorites(options):
+    return [curator.ArtObject(id, f'Title {id}', 'Artist', '1900', 'French', 'Oil', f'url{id}') for id in range(options.favorites)]
+
+
+@benchmark('favorites.add')
+def prepareFavoritesAdd(options, server, scratch):
+    _museum(server, scratch).close()
+    user = curator.User('bench', flushDelay=3600)
+    favorites = _favorites(options)
+    def run(samples):
+        for artObject in favorites:
+            started = time.perf_counter()
+            user.addFavorite(artObject)
+            samples.append(time.perf_counter() - started)
+        user.flush()
+        return len(favorites)
+    return run, lambda: None
+
+
+@benchmark('favorites.isFavorite')
+def prepareIsFavorite(options, server, scratch):
+    _museum(server, scratch).close()
+    user = curator.User('bench', flushDelay=3600)
+    favorites = _favorites(options)
+    for artObject in favorites:
+        user.addFavorite(artObject)
+    def run(samples):
+        for artObject in favorites:
+            started = time.perf_counter()
+            user.isFavorite(artObject.objectId)
+            samples.append(time.perf_counter() - started)
+        return len(favorites)
+    return run, user.flush
+
+
+@benchmark('favorites.import')
+def prepareFavoritesImport(options, server, scratch):
+    _museum(server, scratch).close()
+    path = os.path.join(scratch, 'bench.curator')
+    with open(path, 'w') as file:
+        curator.writeFavorites(file, _favorites(options))
+    user = curator.User('bench')
+    def run(samples):
+        with open(path) as file:
+            return len(user.importFavorites(file))
+    return run, lambda: None
+
+
+@benchmark('favorites.export')
+def prepareFavoritesExport(options, server, scratch):
+    _museum(server, scratch).close()
+    user = curator.User('bench')
+    path = os.path.join(scratch, 'bench.curator')
+    with open(path, 'w') as file:
+        curator.writeFavorites(file, _favorites(options))
+    with open(path) as file:
+        user.importFavorites(file)
+    def run(samples):
+        with open(path, 'w') as file:
+            return user.exportFavorites(file)
+    return run, lambda: None
+
+
+def _prepareResults(container):
+    def prepare(options, server, scratch):
+        # records as the API returns them, so every run parses fresh strings
+        records = [json.dumps({
+            'objectID': id, 'title': f'Title {id}', 'artistDisplayName': f'Artist {id % 97}', 'objectDate': str(1800 + id % 200),
+            'artistNationality': 'French', 'medium': 'Oil on canvas', 'primaryImageSmall': f'https://images.example/{id}.jpg'
+        }) for id in range(options.results)]
+        query = curator.Query(None)
+        def run(samples):
+            results = container(query._buildArtObject(json.loads(record)) for record in records)
+            return len(results)
+        return run, lambda: None
+    return prepare
+
+# the same results held as a list of ArtObjects and as a columnar ResultSet,
+# compare their peak memory
+benchmark('results[list]')(_prepareResults(list))
+benchmark('results[columnar]')(_prepareResults(curator.ResultSet))
+
+
+def writeCollectionCsv(path, rows):
+    '''
+    Write a synthetic MetObjects.csv with rows objects
+    '''
+    import parse_to_sql
+    departments = list(curator.DEPARTMENTS)
+    classifications = ['Paintings', 'Drawings', 'Ceramics', 'Prints', 'Sculpture']
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(parse_to_sql.CSV_COLUMNS)
+        for id in range(1, rows + 1):
+            writer.writerow((
+                id, f'Object {id}', f'Artist {id % 97}', str(1800 + id % 200), 'French',
+                'Oil on canvas', departments[id % len(departments)], classifications[id % len(classifications)],
+                1800 + id % 200, 1800 + id % 200, 'False', str(id % 900) if id % 3 else '',
+                'True', '', 'France', 'Paris', '', 'Portraits|Women'
+            ))
+
+
+def _prepareIngest(workers):
+    def prepare(options, server, scratch):
+        import parse_to_sql
+        path = os.path.join(scratch, 'MetObjects.csv')
+        if not os.path.exists(path):
+            writeCollectionCsv(path, options.csvRows)
+        dbPath = os.path.join(scratch, f'ingest-{time.monotonic_ns()}.db')
+        def run(samples):
+            with contextlib.redirect_stdout(io.StringIO()):
+                parse_to_sql.refresh(dbPath, source=path, workers=workers)
+            return options.csvRows
+        return run, lambda: curator.Database(dbPath).close()
+    return prepare
+
+benchmark('ingest[serial]')(_prepareIngest(1))
+benchmark('ingest[parallel]')(_prepareIngest(2))
+
+
+def percentile(values, p):
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def measure(prepare, options, server, scratch):
+    '''
+    Time prepare()'s work over options.runs runs, then do one more run
+    under tracemalloc for its peak memory so tracing doesn't skew the times.
+    Latency percentiles are taken over every item's latency, or over the
+    run times for benchmarks that don't time items.
+    '''
+    durations = []
+    samples = []
+    items = 0
+    for i in range(options.runs):
+        run, cleanup = prepare(options, server, scratch)
+        started = time.perf_counter()
+        items += run(samples)
+        durations.append(time.perf_counter() - started)
+        cleanup()
+    latencies = samples or durations
+    run, cleanup = prepare(options, server, scratch)
+    tracemalloc.start()
+    try:
+        run([])
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        cleanup()
+    return {
+        'runs': options.runs,
+        'items': items,
+        'seconds': sum(durations),
+        'throughput': items / sum(durations) if sum(durations) else None,
+        'latencyOf': 'item' if samples else 'run',
+        'samples': len(latencies),
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'peakMemoryBytes': peak,
+    }
+
+
+def runBenchmarks(options):
+    '''
+    Run the selected benchmarks against a fresh mock server and return the
+    results as a dict
+    '''
+    names = options.only or list(BENCHMARKS)
+    scratch = tempfile.mkdtemp(prefix='curator-bench-')
+    dbPath = curator.DB_PATH
+    results = {}
+    try:
+        with MockMetServer(options.objects, options.latency, options.jitter, options.errorRate, options.throttleRate, options.seed) as server:
+            host = urlsplit(server.url).netloc
+            curator.RateLimiter.setForHost(host, curator.RateLimiter(rate=options.rateLimit))
+            try:
+                for name in names:
+                    logging.info(f'Running {name}')
+                    results[name] = measure(BENCHMARKS[name], options, server, scratch)
+            finally:
+                curator.RateLimiter.setForHost(host, None)
+            statuses = server.getStatuses()
+            config = server.getConfig()
+    finally:
+        curator.DB_PATH = dbPath
+        curator.ConnectionManager.closeAll()
+        shutil.rmtree(scratch, ignore_errors=True)
+    config.update({'runs': options.runs, 'favorites': options.favorites, 'csvRows': options.csvRows, 'rateLimit': options.rateLimit})
+    return {
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'serverStatuses': statuses,
+        'benchmarks': results,
+    }
+
+
+def findRegressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    '''
+    Names of the benchmarks whose p50 grew by more than tolerance over the
+    baseline results
+    '''
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if previous and result['p50'] > previous['p50'] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description='Offline curator benchmarks against a mock Met API')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--objects', type=int, default=100, help='objects returned by a search')
+    parser.add_argument('--latency', type=float, default=0.01, help='mean server latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.005, help='latency jitter in seconds, either way')
+    parser.add_argument('--error-rate', dest='errorRate', type=float, default=0.0, help='fraction of requests answered with a 500')
+    parser.add_argument('--throttle-rate', dest='throttleRate', type=float, default=None, help='requests per second the server allows before answering 429')
+    parser.add_argument('--rate-limit', dest='rateLimit', type=float, default=curator.DEFAULT_RATE_LIMIT, help='client side requests per second')
+    parser.add_argument('--favorites', type=int, default=10000, help='favorites used by the favorites benchmarks')
+    parser.add_argument('--results', type=int, default=20000, help='art objects held by the results benchmarks')
+    parser.add_argument('--csv-rows', dest='csvRows', type=int, default=20000, help='rows in the synthetic collection CSV')
+    parser.add_argument('--seed', type=int, default=0, help='seed for injected latency and errors')
+    parser.add_argument('--only', action='append', choices=list(BENCHMARKS), help='run just this benchmark, may be repeated')
+    parser.add_argument('--output', default=DEFAULT_RESULTS, help='JSON file for the results')
+    parser.add_argument('--baseline', help='earlier results file to compare p50s against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='allowed p50 growth over the baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parseArguments(argv)
+    # httpx logs every request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    results = runBenchmarks(options)
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for name, result in results['benchmarks'].items():
+        print(f"{name:28} {result['throughput'] or 0:12.1f} items/s  per {result['latencyOf']:4}  p50 {result['p50'] * 1000:9.3f} ms  p95 {result['p95'] * 1000:9.3f} ms  p99 {result['p99'] * 1000:9.3f} ms  peak {result['peakMemoryBytes'] / 1e6:8.1f} MB")
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = findRegressions(results, json.load(f), options.tolerance)
+        if regressions:
+            print('Regressions: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
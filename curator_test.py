@@ -1,5 +1,48 @@
 import pytest
 import curator
+import io
+import json
+import time
+import threading
+import csv
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+@pytest.fixture
+def mockServer():
+    # the benchmarks' stand-in for the Met API: a search finds objects 1-3
+    # and object 404 doesn't exist
+    from curator_bench import MockMetServer
+    with MockMetServer(objects=3, missing={404}, imageSize=(64, 48)) as server:
+        yield server
+
+
+@pytest.fixture
+def stubServer(mockServer):
+    return mockServer.url
+
+
+@pytest.fixture
+def stubMuseum(stubServer, tmp_path, monkeypatch):
+    # Point the library at a scratch database that already has the
+    # classifications table so Museum does not download the collection CSV
+    dbPath = str(tmp_path / 'curator.db')
+    monkeypatch.setattr(curator, 'DB_PATH', dbPath)
+    conn = curator.sqlite3.connect(dbPath)
+    conn.execute('CREATE TABLE classifications (Classification, Id, PRIMARY KEY (Classification))')
+    conn.commit()
+    conn.close()
+    museum = curator.Museum(
+        name = "Stub Museum",
+        searchUrlBase = f'{stubServer}/search?',
+        objectUrlBase = f'{stubServer}/objects/'
+    )
+    yield museum
+    museum.close()
+
 
 # Using xunit style setup and tear down
 class TestClass:
@@ -48,4 +91,612 @@ class TestClass:
         response = query.runQuery()
         assert len(response) > 0
         user.addFavorite(response[0])
-        assert user.getFavorites().pop().getTitle() == "The Laundress"
\ No newline at end of file
+        assert user.getFavorites().pop().getTitle() == "The Laundress"
+
+
+def testSessionReusesConnections(stubServer):
+    session = curator.HttpSession(poolSize=2)
+    for id in range(5):
+        assert session.get(f'{stubServer}/objects/{id}').json()['objectID'] == id
+    stats = session.getStats()
+    session.close()
+    assert stats['requests'] == 5
+    assert stats['connectionsOpened'] == 1
+    assert stats['connectionsReused'] == 4
+
+
+@pytest.mark.parametrize('engine', [curator.ENGINE_THREADED, curator.ENGINE_ASYNC])
+def testFetchEngines(stubMuseum, engine):
+    if engine == curator.ENGINE_ASYNC:
+        pytest.importorskip('httpx')
+    query = curator.Query(stubMuseum, engine=engine)
+    query.setParameter("q", "Object")
+    resultSet = query.fetchArtObjects()
+    titles = [artObject.getTitle() for artObject in resultSet]
+    assert titles == ['Object 1', 'Object 2', 'Object 3']
+
+
+@pytest.mark.parametrize('engine', [curator.ENGINE_THREADED, curator.ENGINE_ASYNC])
+def testStreamArtObjects(stubMuseum, engine):
+    if engine == curator.ENGINE_ASYNC:
+        pytest.importorskip('httpx')
+    query = curator.Query(stubMuseum, engine=engine)
+    streamed = [artObject.getObjectId() for artObject in query.streamArtObjects()]
+    assert sorted(streamed) == [1, 2, 3]
+    ordered = [artObject.getObjectId() for artObject in query.streamArtObjects(ordered=True)]
+    assert ordered == [1, 2, 3]
+    # an ID asked for twice is fetched once and returned in both places
+    curator.Database(curator.DB_PATH).execute('DELETE FROM objectCache')
+    repeated = [artObject.getObjectId() for artObject in query._streamObjects([2, 2, 1, 3, 1], ordered=True)]
+    assert repeated == [2, 2, 1, 3, 1]
+    curator.Database(curator.DB_PATH).execute('DELETE FROM objectCache')
+    assert sorted(artObject.getObjectId() for artObject in query._streamObjects([2, 2, 1, 3, 1])) == [1, 1, 2, 2, 3]
+
+
+def testAsyncFetcherKeepsOneLoop(mockServer, stubServer):
+    pytest.importorskip('httpx')
+    fetcher = curator.AsyncFetcher(maxConcurrency=1)
+    for id in range(3):
+        responses = list(fetcher.iterate([(f'{stubServer}/objects/{id}', {})]))
+        assert responses[0].json()['objectID'] == id
+    assert list(fetcher.iterate([(f'{stubServer}/objects/1', {})], settle=lambda index, response: index)) == [0]
+    thread = fetcher._loopThread
+    executor = fetcher._executor
+    # every stream went over the same client and its kept-alive connection
+    assert len(mockServer.connections) == 1
+    fetcher.close()
+    assert not thread.is_alive()
+    # and the settle() workers were stopped with it
+    assert not any(t.is_alive() for t in executor._threads)
+
+
+def testResultPages(stubMuseum):
+    query = curator.Query(stubMuseum)
+    pages = query.pagedResults(pageSize=2)
+    assert pages.getTotal() == 3
+    assert pages.getPageCount() == 2
+    assert sorted(a.getObjectId() for a in pages.iterPage(0)) == [1, 2]
+    assert [a.getObjectId() for a in pages.getPage(1)] == [3]
+    assert [a.getObjectId() for a in pages.getRows(1, 3)] == [2, 3]
+    assert pages.getPage(2) == []
+    pages.close()
+
+    # a page still streaming when its search is replaced is dropped
+    pages = query.pagedResults(pageSize=2)
+    stream = pages.iterPage(0)
+    next(stream)
+    pages.close()
+    stream.close()
+    assert not pages.isLoaded(0)
+
+
+@pytest.mark.parametrize('engine', [curator.ENGINE_THREADED, curator.ENGINE_ASYNC])
+def testObjectCache(stubMuseum, engine):
+    if engine == curator.ENGINE_ASYNC:
+        pytest.importorskip('httpx')
+    query = curator.Query(stubMuseum, engine=engine)
+    first = [a.getTitle() for a in query.fetchArtObjects()]
+    requestsBefore = stubMuseum.getSessionStats()['requests']
+    second = [a.getTitle() for a in query.fetchArtObjects()]
+    assert first == second
+    # the repeat search is served without any network calls
+    assert stubMuseum.getSessionStats()['requests'] == requestsBefore
+    assert stubMuseum.getObjectCache().getStats()['hits'] == 3
+
+
+def testObjectCacheRevalidates(stubMuseum):
+    cache = curator.ObjectCache(ttl=0)
+    url = stubMuseum.getObjectUrlBase() + '7'
+    assert cache.fetch(stubMuseum.getSession(), 7, url)['objectID'] == 7
+    assert cache.fetch(stubMuseum.getSession(), 7, url)['objectID'] == 7
+    assert cache.getStats() == {'hits': 0, 'misses': 1, 'revalidated': 1, 'coalesced': 0}
+
+
+def testCanonicalParameters():
+    assert curator.canonicalParameters({'q': '  The   Laundress ', 'isOnView': 'True'}) == \
+        curator.canonicalParameters({'isOnView': True, 'q': 'The Laundress'})
+
+
+def testSearchCache(stubMuseum):
+    query = curator.Query(stubMuseum)
+    query.setParameter("q", "Object")
+    assert query._fetchObjectIds() == 3
+    requestsBefore = stubMuseum.getSessionStats()['requests']
+    again = curator.Query(stubMuseum)
+    again.setParameter("q", " Object ")
+    assert again._fetchObjectIds() == 3
+    assert stubMuseum.getSessionStats()['requests'] == requestsBefore
+    # a fresh in-memory tier still finds the result in SQLite
+    stubMuseum.getSearchCache().clear()
+    assert again._fetchObjectIds() == 3
+    assert stubMuseum.getSearchCache().getStats()['diskHits'] == 1
+
+
+def testImageCache(stubMuseum, stubServer, tmp_path):
+    cache = curator.ImageCache(stubMuseum.getSession(), cacheDir=str(tmp_path / 'images'))
+    url = f'{stubServer}/images/1.jpg'
+    image = cache.getImage(url, (32, 32))
+    assert image.size == (32, 24)
+    assert cache.getImage(url, (32, 32)) is image
+    assert cache.getImage(url).size == (64, 48)
+    stats = cache.getStats()
+    assert stats['misses'] == 1 and stats['hits'] == 1 and stats['decodedHits'] == 1
+
+
+def testImageCacheEvicts(stubMuseum, stubServer, tmp_path):
+    cache = curator.ImageCache(stubMuseum.getSession(), cacheDir=str(tmp_path / 'images'), maxBytes=1)
+    cache.getBytes(f'{stubServer}/images/1.jpg')
+    cache.getBytes(f'{stubServer}/images/2.jpg')
+    stats = cache.getStats()
+    assert stats['files'] == 1 and stats['evictions'] == 1
+
+
+def testImagePrefetcher(stubMuseum, stubServer, tmp_path):
+    cache = curator.ImageCache(stubMuseum.getSession(), cacheDir=str(tmp_path / 'images'))
+    prefetcher = curator.ImagePrefetcher(cache, maxBytesPerSecond=None)
+    urls = [f'{stubServer}/images/{id}.jpg' for id in range(4)]
+    prefetcher.prefetch(urls, (32, 32))
+    prefetcher.wait(timeout=10)
+    prefetcher.close()
+    assert prefetcher.getStats()['completed'] == 4
+    cache.getImage(urls[0], (32, 32))
+    assert cache.getStats()['decodedHits'] == 1
+
+
+def writeMetObjectsCsv(path, rows):
+    import parse_to_sql
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(parse_to_sql.CSV_COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+
+
+LAUNDRESS = (1, 'The Laundress', 'Edgar Degas', '1873', 'French', 'Oil on canvas', 'European Paintings', 'Paintings', 1873, 1873, 'True', '815', 'False', '', 'France', 'Paris', '', '')
+BOWL = (2, 'Bowl', '', '1900', '', 'Porcelain', 'Asian Art', 'Ceramics', 1900, 1900, 'False', '', 'True', 'China', 'China', '', '', '')
+STUDY = (3, 'The Laundress, study', 'Edgar Degas', '1872', 'French', 'Charcoal', 'Drawings and Prints', 'Drawings', 1872, 1872, 'False', '', 'True', '', '', '', '', '')
+
+
+def testLocalBackend(stubMuseum, tmp_path):
+    import parse_to_sql
+    csvPath = tmp_path / 'MetObjects.csv'
+    writeMetObjectsCsv(csvPath, [LAUNDRESS, BOWL, STUDY])
+    mirror = parse_to_sql.met_csv(str(csvPath), chunk_size=2)
+    mirror.db_path = curator.DB_PATH
+    mirror.ingest()
+    assert mirror.rows == 3
+    assert mirror.parse_unique_classification(['|']) == ['Paintings', 'Ceramics', 'Drawings']
+    collection = stubMuseum.getLocalCollection()
+    assert collection.isAvailable()
+    assert collection.search({'q': 'laundress', 'title': 'true'}) == [1, 3]
+    assert collection.search({'q': 'degas', 'isOnView': 'true'}) == [1]
+    assert collection.search({'departmentId': '6', 'dateBegin': '1800', 'dateEnd': '2000'}) == [2]
+    # a half-typed year drops the date filter instead of failing the search
+    assert collection.search({'departmentId': '6', 'dateBegin': '18', 'dateEnd': '20x'}) == [2]
+    query = curator.Query(stubMuseum, backend=curator.BACKEND_LOCAL)
+    query.setParameter('q', 'Laundress')
+    titles = [a.getTitle() for a in query.fetchArtObjects()]
+    # image URLs aren't in the CSV, so details come from the API the first time
+    assert titles == ['Object 1', 'Object 3']
+    requestsBefore = stubMuseum.getSessionStats()['requests']
+    titles = [a.getTitle() for a in query.fetchArtObjects()]
+    assert titles == ['The Laundress', 'The Laundress, study']
+    assert stubMuseum.getSessionStats()['requests'] == requestsBefore
+
+
+def testIncrementalRefresh(stubMuseum, tmp_path):
+    import os
+    import parse_to_sql
+    csvPath = tmp_path / 'MetObjects.csv'
+    writeMetObjectsCsv(csvPath, [LAUNDRESS, BOWL, STUDY])
+    assert parse_to_sql.refresh(curator.DB_PATH, source=str(csvPath)) == 'created'
+    assert parse_to_sql.refresh(curator.DB_PATH, source=str(csvPath)) == 'unchanged'
+    # retitle one object, drop the bowl and add a new classification
+    vase = (4, 'Vase', '', '1700', '', 'Glass', 'Asian Art', 'Glass', 1700, 1700, 'False', '', 'True', '', '', '', '', '')
+    writeMetObjectsCsv(csvPath, [LAUNDRESS, STUDY[:1] + ('A study',) + STUDY[2:], vase])
+    os.utime(csvPath, ns=(0, 10**18))
+    assert parse_to_sql.refresh(curator.DB_PATH, source=str(csvPath)) == 'updated'
+    collection = stubMuseum.getLocalCollection()
+    assert collection.search({'q': 'laundress', 'title': 'true'}) == [1]
+    assert collection.search({'q': 'study'}) == [3]
+    assert collection.search({}) == [1, 3, 4]
+    assert sorted(parse_to_sql.get_classifications(curator.DB_PATH)) == ['Drawings', 'Glass', 'Paintings']
+
+
+def testIngestDoesNotHoldTheWriter(tmp_path, monkeypatch):
+    import parse_to_sql
+    dbPath = str(tmp_path / 'curator.db')
+    ingest = parse_to_sql.met_csv('unused.csv')
+    ingest.db_path = dbPath
+    departments = parse_to_sql.department_id_lookup()
+    # a slow download: batches trickle in over about a second
+    def slowBatches(stream):
+        for row in (LAUNDRESS, BOWL, STUDY):
+            time.sleep(0.3)
+            yield [parse_to_sql.mirror_row(row, departments)], {'classification': {row[7]: 1}, 'department': {row[6]: 1}}
+    monkeypatch.setattr(ingest, 'batches', slowBatches)
+    loading = threading.Thread(target=ingest.ingest)
+    loading.start()
+    time.sleep(0.1)
+    # other writers carry on while the csv is still coming in
+    started = time.perf_counter()
+    curator.Database(dbPath).putCachedSearch('q=degas', '[1]', time.time())
+    waited = time.perf_counter() - started
+    loading.join()
+    assert waited < 0.3
+    assert curator.Database(dbPath).query('SELECT count(*) FROM mirrorObjects')[0][0] == 3
+
+
+def testParallelIngestMatchesSerial(tmp_path):
+    import parse_to_sql
+    csvPath = tmp_path / 'MetObjects.csv'
+    rows = []
+    for id in range(1, 61):
+        # quoted commas, quotes and newlines must not split a record
+        title = f'Study {id}, "after" Degas\nsecond line' if id % 7 == 0 else f'Object {id}'
+        rows.append((id, title, 'Artist', '1900', '', 'Oil', 'Asian Art', f'Class {id % 4}', 1900, 1900, 'False', '', 'True', '', '', '', '', ''))
+    writeMetObjectsCsv(csvPath, rows)
+    header, ranges = parse_to_sql.split_ranges(str(csvPath), 8)
+    assert len(ranges) > 1
+    results = {}
+    for workers in (1, 3):
+        dbPath = str(tmp_path / f'curator{workers}.db')
+        ingest = parse_to_sql.met_csv(str(csvPath), chunk_size=7)
+        ingest.db_path = dbPath
+        ingest.range_bytes = 300
+        ingest.ingest(workers=workers)
+        conn = curator.sqlite3.connect(dbPath)
+        objects = conn.execute('SELECT * FROM mirrorObjects ORDER BY objectId').fetchall()
+        facets = conn.execute('SELECT * FROM collectionFacets ORDER BY facet, value').fetchall()
+        conn.close()
+        results[workers] = (objects, facets, list(ingest.classifications))
+    assert len(results[1][0]) == 60
+    assert results[1] == results[3]
+
+
+def testDatabaseBulkWrites(tmp_path):
+    db = curator.Database(str(tmp_path / 'bulk.db'))
+    user = curator.User.__new__(curator.User)
+    user._name = 'bulk'
+    artObjects = [curator.ArtObject(id, f'Title {id}', '', '', '', '', f'url{id}') for id in range(1000)]
+    with db.transaction():
+        db.upsertArtObjects(user, artObjects)
+        db.upsertArtObjects(user, artObjects[:10])
+    assert len(db.getFavorites(user)) == 1000
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.removeArtObjects(user, artObjects)
+            raise RuntimeError('rolled back')
+    assert len(db.getFavorites(user)) == 1000
+    db.removeArtObjects(user, artObjects[:500])
+    assert len(db.getFavorites(user)) == 500
+    assert db.query('PRAGMA journal_mode')[0][0] == 'wal'
+
+
+def testConnectionManager(tmp_path):
+    dbPath = str(tmp_path / 'managed.db')
+    db = curator.Database(dbPath)
+    manager = curator.ConnectionManager.forPath(dbPath)
+    assert curator.Database(dbPath)._manager is manager
+    user = curator.User.__new__(curator.User)
+    user._name = 'writer'
+
+    # concurrent writers all go through the one writer thread
+    def save(start):
+        for id in range(start, start + 50):
+            db.upsertArtObjects(user, [curator.ArtObject(id, f'Title {id}', '', '', '', '', '')])
+    threads = [threading.Thread(target=save, args=(start,)) for start in range(0, 400, 50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(db.getFavorites(user)) == 400
+
+    # a failing queued write is rolled back on its own
+    with pytest.raises(curator.sqlite3.OperationalError):
+        db.execute('INSERT INTO missing VALUES (1)')
+    db.removeArtObjects(user, [curator.ArtObject(0, '', '', '', '', '', '')])
+    assert len(db.getFavorites(user)) == 399
+
+    # read connections are closed with the threads that opened them, only
+    # this thread's is still open
+    for i in range(20):
+        thread = threading.Thread(target=db.getFavorites, args=(user,))
+        thread.start()
+        thread.join()
+    assert sum(closer.alive for closer in manager._readers) == 1
+
+    db.close()
+    with pytest.raises(curator.sqlite3.ProgrammingError):
+        manager.write(lambda connection: None)
+    assert curator.ConnectionManager.forPath(dbPath) is not manager
+
+
+def testFavoritesWriteBehind(tmp_path, monkeypatch):
+    monkeypatch.setattr(curator, 'DB_PATH', str(tmp_path / 'favorites.db'))
+    user = curator.User('collector', flushDelay=60)
+    laundress = curator.ArtObject(436839, 'The Laundress', 'Honoré Daumier', '', '', '', 'url')
+    bowl = curator.ArtObject('42', 'Bowl', '', '', '', '', 'url')
+    user.addFavorite(laundress)
+    user.addFavorite(bowl)
+    user.addFavorite(curator.ArtObject('436839', 'The Laundress', '', '', '', '', 'url'))
+    # int and str IDs are the same favorite
+    assert user.isFavorite('436839') and user.isFavorite(42)
+    assert [f.getTitle() for f in user.getFavorites()] == ['Bowl', 'The Laundress']
+    # nothing is written until the flush
+    assert curator.User('collector').getFavorites() == []
+    user.flush()
+    assert len(curator.User('collector').getFavorites()) == 2
+
+    user.removeFavorite(bowl)
+    assert not user.isFavorite(42)
+    user.flush()
+    assert [f.getTitle() for f in curator.User('collector').getFavorites()] == ['The Laundress']
+
+    # the timer flushes on its own
+    eager = curator.User('eager', flushDelay=0.05)
+    eager.addFavorite(bowl)
+    timer = eager._flushTimer
+    timer.join()
+    assert len(curator.User('eager').getFavorites()) == 1
+
+
+def testFavoritesImportExport(tmp_path, monkeypatch):
+    monkeypatch.setattr(curator, 'DB_PATH', str(tmp_path / 'favorites.db'))
+    source = curator.User('source')
+    for id in range(3):
+        source.addFavorite(curator.ArtObject(id, f'Title {id}', 'Artist', '1900', '', 'Oil', f'url{id}'))
+    path = tmp_path / 'export.curator'
+    with open(path, 'w') as file:
+        assert source.exportFavorites(file) == 3
+    # same layout the old json.dump export produced
+    records = json.loads(path.read_text())
+    assert records[0] == {'artist': 'Artist', 'date': '1900', 'imageUrl': 'url0', 'medium': 'Oil', 'nationality': '', 'objectId': 0, 'title': 'Title 0'}
+    with open(path) as file:
+        assert list(curator.readFavorites(file, chunkSize=7)) == records
+
+    target = curator.User('target')
+    target.addFavorite(curator.ArtObject('1', 'Title 1', '', '', '', '', 'url1'))
+    with open(path) as file:
+        added = target.importFavorites(file)
+    assert sorted(a.objectId for a in added) == [0, 2]
+    assert len(curator.User('target').getFavorites()) == 3
+
+    # a large file streams in and commits in one go
+    many = [curator.ArtObject(id, f'T{id}', '', '', '', '', f'u{id}') for id in range(100000)]
+    with open(path, 'w') as file:
+        curator.writeFavorites(file, many)
+    started = time.monotonic()
+    with open(path) as file:
+        assert len(target.importFavorites(file)) == 100000 - 3
+    assert time.monotonic() - started < 10
+    assert len(curator.User('target').getFavorites()) == 100000
+
+    with pytest.raises(ValueError):
+        list(curator.readFavorites(io.StringIO('[{"objectId": 1}, ')))
+
+
+# Budget in seconds for a cold "import curator", measured with -X importtime
+IMPORT_BUDGET = 0.25
+
+def testImportBudget():
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import sys, curator; print(" ".join(m for m in ("tkinter", "PIL", "pandas", "requests", "httpx") if m in sys.modules))'],
+        cwd=here, capture_output=True, text=True, check=True)
+    # the core pulls in none of the heavy or GUI dependencies
+    assert result.stdout.strip() == ''
+    cumulative = [int(line.split('|')[1]) for line in result.stderr.splitlines() if line.rstrip().endswith('| curator')]
+    assert cumulative[0] / 1e6 < IMPORT_BUDGET
+
+
+def testMuseumLoadsClassificationsLazily(tmp_path, monkeypatch):
+    monkeypatch.setattr(curator, 'DB_PATH', str(tmp_path / 'lazy.db'))
+    calls = []
+    monkeypatch.setattr(curator.Museum, 'get_classifications', lambda self: calls.append(1) or ['Paintings'])
+    museum = curator.Museum("Lazy Museum", 'http://127.0.0.1:9/search?', 'http://127.0.0.1:9/objects/')
+    # constructing the museum must not build the tables or download the CSV
+    assert calls == []
+    assert museum.getClassifications() == ['Paintings']
+    assert museum.getClassifications() == ['Paintings']
+    assert calls == [1]
+    museum.close()
+
+    user = curator.User('later', load=False)
+    user.addFavorite(curator.ArtObject(7, 'Seven', '', '', '', '', ''))
+    user.loadFavorites()
+    # changes made before the background load are kept
+    assert user.isFavorite(7)
+
+
+def testRateLimiter():
+    limiter = curator.RateLimiter(rate=100, burst=1)
+    delays = [limiter.reserve() for i in range(10)]
+    assert delays[0] == 0
+    assert delays[-1] == pytest.approx(0.09, abs=0.01)
+    limiter.onThrottled(retryAfter=0.5)
+    assert limiter.getRate() == 50
+    assert limiter.reserve() >= 0.45
+    limiter.onSuccess()
+    assert limiter.getRate() > 50
+    assert curator._retryAfterSeconds('2') == 2
+    assert curator._retryAfterSeconds('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+
+
+@pytest.mark.parametrize('engine', [curator.ENGINE_THREADED, curator.ENGINE_ASYNC])
+def testRetriesAndSkipsFailures(mockServer, stubServer, stubMuseum, monkeypatch, engine):
+    policy = curator.RetryPolicy(backoffBase=0.001)
+    mockServer.scripted['/objects/7'] = [429, 503, 500]
+    session = curator.HttpSession(retryPolicy=policy)
+    assert session.get(f'{stubServer}/objects/7').json()['objectID'] == 7
+    outcomes = session.getStats()['outcomes']
+    assert outcomes['throttled'] == 2 and outcomes['serverError'] == 1 and outcomes['retries'] == 3 and outcomes['ok'] == 1
+    assert curator.RateLimiter.forHost(stubServer[len('http://'):]).getRate() < curator.DEFAULT_RATE_LIMIT
+    session.close()
+
+    # a throttled lookup is retried and a missing object is skipped, the
+    # rest of the results still arrive
+    monkeypatch.setattr(stubMuseum, '_session', curator.HttpSession(retryPolicy=policy))
+    if engine == curator.ENGINE_ASYNC:
+        monkeypatch.setattr(stubMuseum, '_asyncFetcher', curator.AsyncFetcher(retryPolicy=policy))
+    mockServer.scripted['/objects/2'] = [429]
+    query = curator.Query(stubMuseum, engine=engine)
+    results = list(query._streamObjects([1, 404, 2, 3], ordered=True))
+    assert [a.getObjectId() for a in results] == [1, 2, 3]
+    assert query.failedIds == [404]
+
+    # runQuery skips an object that still fails once the retries run out
+    curator.Database(curator.DB_PATH).execute('DELETE FROM objectCache')
+    mockServer.scripted['/objects/3'] = [500] * (curator.DEFAULT_MAX_RETRIES + 1)
+    query = curator.Query(stubMuseum, engine=engine)
+    query.setParameter('q', 'failing')
+    assert [a.getObjectId() for a in query.runQuery()] == [1, 2]
+    assert query.failedIds == [3]
+
+
+def testSingleFlight():
+    flight = curator.SingleFlight()
+    release = threading.Event()
+    calls = []
+    def work():
+        calls.append(1)
+        release.wait()
+        raise ValueError('shared failure')
+    with ThreadPoolExecutor(3) as pool:
+        futures = [pool.submit(flight.do, 'key', work) for i in range(3)]
+        while flight.getStats()['calls'] < 3:
+            time.sleep(0.01)
+        release.set()
+    assert all(isinstance(f.exception(), ValueError) for f in futures)
+    assert calls == [1]
+    assert flight.getStats() == {'calls': 3, 'executed': 1, 'coalesced': 2}
+
+    # a leader that gives up passes the error on instead of leaving followers waiting
+    future, leader = flight.claim('abandoned')
+    shared, follows = flight.claim('abandoned')
+    assert leader and not follows and shared is future
+    flight.abandon('abandoned', future, curator.FetchError('stopped early'))
+    with pytest.raises(curator.FetchError):
+        shared.result(timeout=1)
+    assert flight.claim('abandoned')[1]
+
+
+@pytest.mark.parametrize('leader, follower', [
+    (curator.ENGINE_THREADED, curator.ENGINE_THREADED),
+    (curator.ENGINE_THREADED, curator.ENGINE_ASYNC),
+    (curator.ENGINE_ASYNC, curator.ENGINE_ASYNC),
+    (curator.ENGINE_ASYNC, curator.ENGINE_THREADED),
+])
+def testConcurrentQueriesShareRequests(mockServer, stubMuseum, leader, follower):
+    mockServer.latency = 0.2
+    # one query leads, the others follow while its lookups are in flight
+    queries = [curator.Query(stubMuseum, engine=leader)] + [curator.Query(stubMuseum, engine=follower) for i in range(3)]
+    def run(query, ordered):
+        return sorted(a.getObjectId() for a in query._streamObjects([5, 6], ordered=ordered))
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(run, queries[0], True)]
+        time.sleep(0.05)
+        futures += [pool.submit(run, query, i % 2 == 0) for i, query in enumerate(queries[1:])]
+        results = [f.result() for f in futures]
+    assert results == [[5, 6]] * 4
+    stats = stubMuseum.getObjectCache().getStats()
+    assert stats['misses'] == 2 and stats['coalesced'] == 6
+
+
+
+def testConcurrentImageRequestsShareDownloads(mockServer, stubServer, stubMuseum, tmp_path):
+    mockServer.latency = 0.2
+    cache = curator.ImageCache(stubMuseum.getSession(), cacheDir=str(tmp_path / 'images'))
+    with ThreadPoolExecutor(4) as pool:
+        images = list(pool.map(cache.getBytes, [f'{stubServer}/images/9.jpg'] * 4))
+    assert len(set(images)) == 1
+    stats = cache.getStats()
+    assert stats['misses'] == 1 and stats['coalesced'] == 3
+
+
+def testBenchmarkSmoke(tmp_path):
+    import curator_bench
+    limiters = set(curator.RateLimiter._limiters)
+    output = tmp_path / 'bench.json'
+    argv = ['--runs', '1', '--objects', '5', '--latency', '0', '--jitter', '0', '--error-rate', '0.5',
+            '--favorites', '50', '--only', 'runQuery', '--only', 'favorites.import', '--output', str(output)]
+    assert curator_bench.main(argv) == 0
+    # the mock server's rate limit override is gone again
+    assert set(curator.RateLimiter._limiters) == limiters
+    results = json.loads(output.read_text())
+    assert set(results['benchmarks']) == {'runQuery', 'favorites.import'}
+    for result in results['benchmarks'].values():
+        assert result['throughput'] > 0 and result['p50'] <= result['p99'] and result['peakMemoryBytes'] > 0
+    # percentiles over every request (the search and five objects), the
+    # import is only timed as a whole
+    assert results['benchmarks']['runQuery']['latencyOf'] == 'item'
+    assert results['benchmarks']['runQuery']['samples'] >= 6
+    assert results['benchmarks']['favorites.import']['latencyOf'] == 'run'
+    assert results['serverStatuses']['500'] > 0
+    # the same results are no regression against themselves, a much faster
+    # baseline is
+    assert curator_bench.findRegressions(results, results) == []
+    faster = json.loads(output.read_text())
+    faster['benchmarks']['runQuery']['p50'] /= 10
+    assert curator_bench.findRegressions(results, faster) == ['runQuery']
+
+
+def testMetrics(stubServer, stubMuseum, tmp_path):
+    import urllib.request
+    metrics = curator.METRICS
+    assert not metrics.isEnabled()
+    # switched off, nothing is recorded and timers are a shared no-op
+    metrics.increment('ignored')
+    assert metrics.timer('a') is metrics.timer('b')
+    assert metrics.snapshot()['counters'] == {}
+    path = tmp_path / 'metrics.jsonl'
+    prometheus = curator.PrometheusSink(port=0)
+    metrics.enable(curator.JsonLinesSink(str(path)), prometheus)
+    try:
+        objects = list(curator.Query(stubMuseum).streamArtObjects())
+        assert objects
+        metrics.observe('sizes', 3, curator.SIZE_BUCKETS)
+        snapshot = metrics.snapshot()
+        assert snapshot['counters']['http.status.200'] == len(objects) + 1
+        assert snapshot['counters']['query.search.cacheMisses'] == 1
+        assert snapshot['histograms']['query.object.seconds']['count'] == len(objects)
+        assert snapshot['histograms']['sizes']['buckets'][2] == (5, 1)
+        with urllib.request.urlopen(f'http://127.0.0.1:{prometheus.port}/metrics') as response:
+            text = response.read().decode('utf-8')
+        assert f'curator_http_status_200_total {len(objects) + 1}' in text
+        assert 'curator_sizes_bucket{le="+Inf"} 1' in text
+    finally:
+        metrics.disable()
+        metrics.reset()
+    lines = path.read_text().splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])['counters']['query.search.cacheMisses'] == 1
+
+
+def testResultSet():
+    import tracemalloc
+    artObjects = [curator.ArtObject(id, f'Title {id}', 'Artist ' + str(id % 7), '1900', 'French', 'Oil', f'url{id}') for id in range(2000)]
+    assert not hasattr(artObjects[0], '__dict__')
+    results = curator.ResultSet(artObjects)
+    assert len(results) == 2000
+    assert results[5].getTitle() == 'Title 5' and results[-1].getObjectId() == 1999
+    assert [a.getArtist() for a in results[:3]] == ['Artist 0', 'Artist 1', 'Artist 2']
+    assert [a.toDict() for a in artObjects] == results.toDicts()
+    # repeated values are stored once
+    assert results[7].getArtist() is results[14].getArtist()
+    # object IDs that aren't integers still work
+    results.append(curator.ArtObject('X1', 'Odd', '', '', '', '', ''))
+    assert results.getColumn('objectId')[-2:] == [1999, 'X1']
+
+    def tracedSize(build):
+        tracemalloc.start()
+        kept = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept
+        return size
+    records = [json.dumps(a.toDict()) for a in artObjects]
+    def objects():
+        return (curator.ArtObject(**json.loads(record)) for record in records)
+    assert tracedSize(lambda: curator.ResultSet(objects())) < tracedSize(lambda: list(objects())) * 0.7
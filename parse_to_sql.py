@@ -3,39 +3,175 @@
 #https://sookocheff.com/post/tools/downloading-directories-of-code-from-github-using-the-github-api/
 #https://jpmens.net/2019/04/04/i-clone-all-repositories-i-ve-starred/
 #https://github.com/metmuseum/openaccess/raw/master/MetObjects.csv
-import csv, sqlite3, pandas, sys, os, json, io
+import csv, pandas, sys, os, json, io, mmap, shutil
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from itertools import islice
 #pip install pandas
 #from github import Github #get this working?
 import requests#currently using 
+from curator import Database, DEPARTMENTS #all writes go through curator's Database
 DB_PATH = "curator.db"
 
 #here lied a boatload of unused test code RIP
 
 #class designed to see if github is updated and then download the csv file if it is
-#warning as of right now downloads csv file every time
+#refresh() sends a conditional get and only applies changed rows
 #quick fix recode
 #https://stackoverflow.com/questions/38925115/sqlite3-operationalerror-near-syntax-error
 
 
+#rows parsed per chunk while streaming the csv
+CHUNK_ROWS = 20000
+#approximate bytes of csv handed to each worker in parallel mode
+RANGE_BYTES = 8 * 1024 * 1024
+
 class met_csv:
-    #right now downloads the csv passed in from url and converts it to a dataframe
-    def __init__(self):
+    #streams the csv from url (or a local file) in chunks, keeping only the
+    #columns we use, so memory stays flat no matter how big the file is
+    def __init__(self, source=None, chunk_size=CHUNK_ROWS):
         #location of csv
         self.url = 'https://github.com/metmuseum/openaccess/raw/master/MetObjects.csv'
-        #switch comments to remove fast test mode on local csv
-        self.df = pandas.read_csv(io.StringIO((requests.get(self.url).content).decode('utf-8')))
-        
-        #use this when testing for faster speed
-        #self.df = pandas.read_csv('MetObjects.csv')
-        print(self.df)
+        #pass a local MetObjects.csv when testing for faster speed
+        self.source = source
+        self.chunk_size = chunk_size
+        #unique classifications in order of first appearance
+        self.classifications = {}
+        self.rows = 0
+        #validators of the downloaded csv, used for the next conditional get
+        self.etag = None
+        self.last_modified = None
+        #rows added/changed and removed by an incremental ingest
+        self.changed = 0
+        self.removed = 0
+        #value -> count for each facet, e.g. facets['department']['Asian Art']
+        self.facets = {'classification': {}, 'department': {}}
+        #parallel mode needs the csv on disk, downloads are saved here
+        self.download_path = None
+        self.range_bytes = RANGE_BYTES
         self.unique_cols = {}
         self.is_good = False
+        self.db_path = DB_PATH
+    def open_stream(self, etag=None, last_modified=None):
+        #returns None when the csv hasn't changed since etag/last_modified
+        if self.source is not None:
+            #local files use their modification time and size as validator
+            stat = os.stat(self.source)
+            self.last_modified = str(stat.st_mtime_ns) + '-' + str(stat.st_size)
+            if last_modified == self.last_modified:
+                return None
+            return open(self.source, 'rb')
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = requests.get(self.url, stream=True, headers=headers)
+        if response.status_code == 304:
+            response.close()
+            return None
+        response.raise_for_status()
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        #let urllib3 undo any gzip transfer encoding while we read
+        response.raw.decode_content = True
+        return response.raw
+    def chunks(self, stream=None):
+        #yields dataframes of at most chunk_size rows with only CSV_COLUMNS
+        if stream is None:
+            stream = self.open_stream()
+        try:
+            for chunk in pandas.read_csv(stream, usecols=list(CSV_COLUMNS), dtype=str, chunksize=self.chunk_size):
+                yield chunk[list(CSV_COLUMNS)]
+        finally:
+            stream.close()
+    def batches(self, stream=None):
+        #serial mode: yields (mirror rows, facet counts) per chunk
+        department_ids = department_id_lookup()
+        for chunk in self.chunks(stream):
+            yield parse_frame(chunk, department_ids)
+    def local_copy(self, stream=None):
+        #path of the csv on disk, saving the download first when needed
+        if self.source is not None:
+            if stream is not None:
+                stream.close()
+            return self.source
+        if stream is None:
+            stream = self.open_stream()
+        path = self.download_path or os.path.join(os.path.dirname(os.path.abspath(self.db_path)), 'MetObjects.csv')
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(stream, f, 1024 * 1024)
+        stream.close()
+        return path
+    def parallel_batches(self, path, workers):
+        #parallel mode: record aligned byte ranges are parsed and cleaned in
+        #a process pool, batches come back in file order
+        header, ranges = split_ranges(path, max(workers, os.path.getsize(path) // self.range_bytes))
+        department_ids = department_id_lookup()
+        #at most 2 ranges per worker in flight, so parsed rows don't pile up
+        #when the workers outrun the staging writer
+        tasks = iter([(path, start, end, header, department_ids) for start, end in ranges])
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            window = deque(executor.submit(parse_range, task) for task in islice(tasks, 2 * workers))
+            while window:
+                future = window.popleft()
+                task = next(tasks, None)
+                if task is not None:
+                    window.append(executor.submit(parse_range, task))
+                yield future.result()
+    def ingest(self, stream=None, mirror=True, incremental=False, workers=1):
+        #one pass over the csv: collects classifications and facet counts and,
+        #when mirror is set, stages every object in a temp table a batch at a
+        #time. only applying the staged rows takes the writer for a whole
+        #transaction, so other writes aren't held up while the csv downloads.
+        #incremental only applies the rows that differ. workers > 1 parses in parallel
+        if workers > 1:
+            batches = self.parallel_batches(self.local_copy(stream), workers)
+        else:
+            batches = self.batches(stream)
+        db = Database(self.db_path)
+        self.stage_batches(db, batches, mirror)
+        with db.transaction():
+            self.apply_staged(db, mirror, incremental)
+        del db
+        print(self.rows, 'rows ingested')
+    def stage_batches(self, db, batches, mirror):
+        #each batch is its own queued write, other writers get a turn in between
+        if mirror:
+            db.execute('''DROP TABLE IF EXISTS temp.mirrorStaging''')
+            db.execute(CREATE_STAGING)
+        for rows, facets in batches:
+            for facet, counts in facets.items():
+                totals = self.facets[facet]
+                for value, count in counts.items():
+                    totals[value] = totals.get(value, 0) + count
+            if mirror:
+                db.executeMany(INSERT_STAGED_ROW, rows)
+            self.rows += len(rows)
+        self.classifications = self.facets['classification']
+    def apply_staged(self, db, mirror, incremental):
+        #moves the staged rows into the mirror tables, runs inside one transaction
+        if mirror and incremental:
+            create_mirror_schema(db)
+            write_departments(db)
+            self.changed, self.removed = merge_staged_rows(db)
+        elif mirror:
+            db.execute('''DROP TABLE IF EXISTS mirrorObjectsFts''')
+            db.execute('''DROP TABLE IF EXISTS mirrorObjects''')
+            db.execute('''DROP TABLE IF EXISTS departments''')
+            create_mirror_schema(db)
+            write_departments(db)
+            db.execute('''INSERT INTO mirrorObjects SELECT * FROM temp.mirrorStaging''')
+            db.execute('''DROP TABLE temp.mirrorStaging''')
+            #fill the full text index from the content table in one pass
+            db.execute('''INSERT INTO mirrorObjectsFts(mirrorObjectsFts) VALUES ('rebuild')''')
+            self.changed = self.rows
+        write_facets(db, self.facets)
     def parse_unique_classification(self,filters):
         #will return unique list of strings for values in 
         #that col not containing list of str filters
 
-        #fix this. this is inefficient
-        my_col = self.df.Classification.unique().tolist()
+        my_col = list(self.classifications)
         for i in filters:
             my_col = [str(item) for item in my_col if str(i) not in str(item)]
 
@@ -44,52 +180,279 @@ class met_csv:
 
         return my_col
     def update_classification_table(self):
-        #horribly inefficient fix this
-        #check needed to ensure 
+        #check needed to ensure classifications were parsed first
         if self.is_good is True:
+            db = Database(self.db_path)
             try:
-                conn=sqlite3.connect(DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute('''DROP TABLE IF EXISTS classifications''')
-                cursor.execute('''CREATE TABLE IF NOT EXISTS classifications (Classification, Id, PRIMARY KEY (Classification))''')
-                counter = 0
-                for i in  self.unique_cols['Classification']:
-
-                    cursor.execute('''INSERT INTO classifications VALUES (?,?)''', (i,counter))
-                    counter= counter+1
-                    #print(i, "inserted")
-
+                with db.transaction():
+                    #only add new classifications and remove ones no longer in
+                    #the csv, existing rows keep their ids
+                    db.execute('''CREATE TABLE IF NOT EXISTS classifications (Classification, Id, PRIMARY KEY (Classification))''')
+                    existing = set(row[0] for row in db.query('''SELECT Classification FROM classifications'''))
+                    wanted = self.unique_cols['Classification']
+                    db.executeMany('''DELETE FROM classifications WHERE Classification=?''',
+                        [(i,) for i in existing - set(wanted)])
+                    counter = db.query('''SELECT coalesce(max(Id) + 1, 0) FROM classifications''')[0][0]
+                    new_rows = []
+                    for i in wanted:
+                        if i not in existing:
+                            new_rows.append((i, counter))
+                            counter = counter + 1
+                    db.executeMany('''INSERT INTO classifications VALUES (?,?)''', new_rows)
             except NameError:
                 print("failed", NameError)
             print('table made?')
-            conn.commit()
-            
+            del db
 
         return
 
+#csv columns kept in the local mirror
+CSV_COLUMNS = (
+    'Object ID', 'Title', 'Artist Display Name', 'Object Date',
+    'Artist Nationality', 'Medium', 'Department', 'Classification',
+    'Object Begin Date', 'Object End Date', 'Is Highlight', 'Gallery Number',
+    'Is Public Domain', 'Culture', 'Country', 'City', 'Region', 'Tags',
+)
+MIRROR_COLUMNS = (
+    'objectId', 'title', 'artist', 'objectDate', 'nationality', 'medium',
+    'departmentId', 'classification', 'beginDate', 'endDate', 'isHighlight',
+    'isOnView', 'isPublicDomain', 'culture', 'country', 'city', 'region', 'tags',
+)
+INSERT_MIRROR_ROW = 'INSERT OR REPLACE INTO mirrorObjects (' + ', '.join(MIRROR_COLUMNS) + \
+    ') VALUES (' + ', '.join('?' for i in MIRROR_COLUMNS) + ')'
+#objects are staged on the writer connection before they reach mirrorObjects
+CREATE_STAGING = '''CREATE TEMP TABLE mirrorStaging (
+    objectId INTEGER PRIMARY KEY, title TEXT, artist TEXT, objectDate TEXT,
+    nationality TEXT, medium TEXT, departmentId INTEGER,
+    classification TEXT, beginDate INTEGER, endDate INTEGER,
+    isHighlight INTEGER, isOnView INTEGER, isPublicDomain INTEGER,
+    culture TEXT, country TEXT, city TEXT, region TEXT, tags TEXT)'''
+INSERT_STAGED_ROW = INSERT_MIRROR_ROW.replace('mirrorObjects', 'temp.mirrorStaging', 1)
+#csv department names that differ from the API names
+DEPARTMENT_ALIASES = {
+    'The American Wing': 'American Decorative Arts',
+    'Robert Lehman Collection': 'The Robert Lehman Collection',
+    'Modern and Contemporary Art': 'Modern Art',
+}
+
+def create_mirror_schema(db):
+    db.execute('''CREATE TABLE IF NOT EXISTS departments (departmentId INTEGER PRIMARY KEY, name TEXT UNIQUE)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS mirrorObjects (
+        objectId INTEGER PRIMARY KEY, title TEXT, artist TEXT, objectDate TEXT,
+        nationality TEXT, medium TEXT,
+        departmentId INTEGER REFERENCES departments (departmentId),
+        classification TEXT, beginDate INTEGER, endDate INTEGER,
+        isHighlight INTEGER, isOnView INTEGER, isPublicDomain INTEGER,
+        culture TEXT, country TEXT, city TEXT, region TEXT, tags TEXT)''')
+    db.execute('''CREATE INDEX IF NOT EXISTS mirrorObjectsDepartment ON mirrorObjects (departmentId)''')
+    db.execute('''CREATE INDEX IF NOT EXISTS mirrorObjectsClassification ON mirrorObjects (classification COLLATE NOCASE)''')
+    db.execute('''CREATE INDEX IF NOT EXISTS mirrorObjectsDates ON mirrorObjects (beginDate, endDate)''')
+    db.execute('''CREATE INDEX IF NOT EXISTS mirrorObjectsHighlight ON mirrorObjects (isHighlight)''')
+    db.execute('''CREATE INDEX IF NOT EXISTS mirrorObjectsOnView ON mirrorObjects (isOnView)''')
+    #external content fts table, the text lives only in mirrorObjects
+    db.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS mirrorObjectsFts USING fts5(
+        title, artist, medium, tags, content='mirrorObjects', content_rowid='objectId')''')
+
+def merge_staged_rows(db):
+    #applies temp.mirrorStaging to mirrorObjects, touching only rows that were
+    #added, changed or removed, and keeps the fts index in step with them.
+    #returns (changed, removed)
+    same = ' AND '.join('m.' + c + ' IS s.' + c for c in MIRROR_COLUMNS[1:])
+    db.execute('''DROP TABLE IF EXISTS temp.mirrorChanged''')
+    db.execute('''CREATE TEMP TABLE mirrorChanged AS SELECT s.objectId AS objectId
+        FROM mirrorStaging s LEFT JOIN mirrorObjects m ON m.objectId = s.objectId
+        WHERE m.objectId IS NULL OR NOT (''' + same + ')')
+    db.execute('''DROP TABLE IF EXISTS temp.mirrorRemoved''')
+    db.execute('''CREATE TEMP TABLE mirrorRemoved AS SELECT objectId FROM mirrorObjects
+        WHERE objectId NOT IN (SELECT objectId FROM mirrorStaging)''')
+    #drop the old text of changed and removed rows from the index
+    db.execute('''INSERT INTO mirrorObjectsFts(mirrorObjectsFts, rowid, title, artist, medium, tags)
+        SELECT 'delete', objectId, title, artist, medium, tags FROM mirrorObjects
+        WHERE objectId IN (SELECT objectId FROM mirrorChanged UNION SELECT objectId FROM mirrorRemoved)''')
+    db.execute('''DELETE FROM mirrorObjects WHERE objectId IN (SELECT objectId FROM mirrorRemoved)''')
+    db.execute('''INSERT OR REPLACE INTO mirrorObjects SELECT * FROM mirrorStaging
+        WHERE objectId IN (SELECT objectId FROM mirrorChanged)''')
+    db.execute('''INSERT INTO mirrorObjectsFts(rowid, title, artist, medium, tags)
+        SELECT objectId, title, artist, medium, tags FROM mirrorObjects
+        WHERE objectId IN (SELECT objectId FROM mirrorChanged)''')
+    counts = db.query('''SELECT (SELECT count(*) FROM mirrorChanged), (SELECT count(*) FROM mirrorRemoved)''')[0]
+    for table in ('mirrorStaging', 'mirrorChanged', 'mirrorRemoved'):
+        db.execute('DROP TABLE temp.' + table)
+    return counts
+
+def parse_frame(chunk, department_ids):
+    #cleans a dataframe of CSV_COLUMNS into mirror rows and facet counts
+    rows = [mirror_row(row, department_ids) for row in chunk.itertuples(index=False)]
+    facets = {}
+    for facet, column in (('classification', 'Classification'), ('department', 'Department')):
+        values = chunk[column].dropna()
+        counts = values.value_counts()
+        #keep values in order of first appearance
+        facets[facet] = {value: int(counts[value]) for value in values.unique()}
+    return rows, facets
+
+def parse_range(task):
+    #process pool worker: parses one byte range of the csv file
+    path, start, end, header, department_ids = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    chunk = pandas.read_csv(io.BytesIO(header + data), usecols=list(CSV_COLUMNS), dtype=str)
+    return parse_frame(chunk[list(CSV_COLUMNS)], department_ids)
+
+def count_quotes(mm, start, end):
+    #counts '"' in mm[start:end] without copying it all at once
+    total = 0
+    for i in range(start, end, RANGE_BYTES):
+        total += mm[i:min(i + RANGE_BYTES, end)].count(b'"')
+    return total
+
+def split_ranges(path, parts):
+    #splits the csv body into about parts byte ranges that each start and end
+    #on a record boundary. fields may hold quoted newlines, so a newline only
+    #ends a record when an even number of quotes precede it
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = len(mm)
+            header_end = mm.find(b'\n') + 1 or size
+            header = mm[:header_end]
+            step = max((size - header_end) // max(parts, 1), 1)
+            bounds = [header_end]
+            position = header_end
+            quotes = 0
+            for k in range(1, parts):
+                target = header_end + k * step
+                if target <= position:
+                    continue
+                quotes += count_quotes(mm, position, target)
+                position = target
+                #move forward to the end of the record we landed in
+                while position < size:
+                    newline = mm.find(b'\n', position)
+                    if newline == -1:
+                        position = size
+                        break
+                    quotes += count_quotes(mm, position, newline + 1)
+                    position = newline + 1
+                    if quotes % 2 == 0:
+                        break
+                if position >= size:
+                    break
+                bounds.append(position)
+            bounds.append(size)
+        finally:
+            mm.close()
+    return header, [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+def write_facets(db, facets):
+    db.execute('''CREATE TABLE IF NOT EXISTS collectionFacets (facet TEXT, value TEXT, count INTEGER, PRIMARY KEY (facet, value))''')
+    db.execute('''DELETE FROM collectionFacets''')
+    db.executeMany('''INSERT INTO collectionFacets (facet, value, count) VALUES (?,?,?)''',
+        [(facet, value, count) for facet, counts in facets.items() for value, count in counts.items()])
+
+def read_meta(db_path):
+    #validators and bookkeeping from the last refresh
+    db = Database(db_path)
+    db.execute('''CREATE TABLE IF NOT EXISTS collectionMeta (name TEXT PRIMARY KEY, value TEXT)''')
+    meta = dict(db.query('''SELECT name, value FROM collectionMeta'''))
+    meta['has_tables'] = db.query('''SELECT count(name) FROM sqlite_master WHERE type='table' AND name IN ('mirrorObjects', 'classifications')''')[0][0] == 2
+    del db
+    return meta
+
+def write_meta(db_path, values):
+    db = Database(db_path)
+    db.executeMany('''INSERT OR REPLACE INTO collectionMeta (name, value) VALUES (?,?)''', list(values.items()))
+    del db
+
+def department_id_lookup():
+    lookup = dict(DEPARTMENTS)
+    for csv_name, api_name in DEPARTMENT_ALIASES.items():
+        lookup[csv_name] = DEPARTMENTS[api_name]
+    return lookup
+
+def write_departments(db):
+    db.executeMany('''INSERT OR REPLACE INTO departments (departmentId, name) VALUES (?,?)''',
+        [(department_id, name) for name, department_id in DEPARTMENTS.items()])
+
+def clean_text(value):
+    #pandas gives NaN for empty cells
+    if value is None or value != value:
+        return ''
+    return str(value)
+
+def clean_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def clean_flag(value):
+    return 1 if str(value).strip().lower() in ('true', '1') else 0
+
+def mirror_row(row, department_ids):
+    #row holds the CSV_COLUMNS values in order
+    (object_id, title, artist, object_date, nationality, medium, department,
+        classification, begin_date, end_date, is_highlight, gallery,
+        is_public_domain, culture, country, city, region, tags) = row
+    return (
+        int(object_id), clean_text(title), clean_text(artist),
+        clean_text(object_date), clean_text(nationality), clean_text(medium),
+        department_ids.get(clean_text(department)), clean_text(classification),
+        clean_int(begin_date), clean_int(end_date), clean_flag(is_highlight),
+        #objects with a gallery number are on view
+        1 if clean_text(gallery) else 0, clean_flag(is_public_domain),
+        clean_text(culture), clean_text(country), clean_text(city),
+        clean_text(region), clean_text(tags),
+    )
+
 def get_classifications(my_path):
     
-    conn=sqlite3.connect(my_path)
-    cursor = conn.cursor()
     query = ('''SELECT Classification FROM classifications;''')
-    cursor.execute(query)
-    rows =cursor.fetchall()
+    rows = Database(my_path).query(query)
     
     temp = []
 
     for i in rows:
         temp.append(i[0])
 
+    return temp
 
 
-    conn.commit()
-    return temp
+MY_FILTERS = ['|','/','-'] #characters to filter out of csv
+
+def refresh(db_path=DB_PATH, source=None, filters=MY_FILTERS, workers=1):
+    #conditional download of the csv: returns 'unchanged' without reading it
+    #when upstream hasn't changed, otherwise applies only the changed rows
+    #('updated'), or builds the tables from scratch the first time ('created').
+    #workers > 1 parses the csv in that many processes
+    meta = read_meta(db_path)
+    cur_met_csv = met_csv(source) #create object that streams the csv
+    cur_met_csv.db_path = db_path
+    if meta['has_tables']:
+        stream = cur_met_csv.open_stream(meta.get('etag'), meta.get('last_modified'))
+    else:
+        stream = cur_met_csv.open_stream()
+    if stream is None:
+        print('collection unchanged')
+        return 'unchanged'
+    # one pass over the csv, filling the local mirror and collecting classifications
+    cur_met_csv.ingest(stream, incremental=meta['has_tables'], workers=workers)
+    cur_met_csv.parse_unique_classification(filters) #filter the collected classifications
+    cur_met_csv.update_classification_table() # add updated values to table in sql db
+    write_meta(db_path, {
+        'etag': cur_met_csv.etag or '',
+        'last_modified': cur_met_csv.last_modified or '',
+        'rows': str(cur_met_csv.rows),
+    })
+    print(cur_met_csv.changed, 'rows changed,', cur_met_csv.removed, 'removed')
+    return 'updated' if meta['has_tables'] else 'created'
 
+def main(db_path=DB_PATH, workers=1):
+    #example code on how to update download and update unique values to Classifications table in db
+    refresh(db_path, workers=workers)
+    print(get_classifications(db_path))#sanity check
 
-#example code on how to update download and update unique values to Classifications table in db
-my_filters = ['|','/','-'] #characters to filter out of csv
-cur_met_csv = met_csv() #create object containing csv loaded into pandas df
-cur_met_csv.parse_unique_classification(my_filters) #convert df into list to filter and sort because
-#I have little experience in pandas
-cur_met_csv.update_classification_table() # add updated values to table in sql db
-print(get_classifications(DB_PATH))#sanity check
\ No newline at end of file
+if __name__ == "__main__":
+    #optional argument: number of worker processes, e.g. python parse_to_sql.py 8
+    main(workers=int(sys.argv[1]) if len(sys.argv) > 1 else 1)
\ No newline at end of file